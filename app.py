@@ -1,9 +1,13 @@
 from pathlib import Path
 from shiny import App, Session, reactive, ui
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Mount, Route
 from modules import surface, depth
 from utils.text_helper import (
     info_modal
 )
+from utils.metrics_helper import METRICS_ENABLED, render_metrics
 
 
 page_dependencies = ui.tags.head(
@@ -86,4 +90,17 @@ def server(input, output, session: Session):
         )
 
 www_dir = Path(__file__).parent / "www"
-app = App(app_ui, server, static_assets=www_dir)
\ No newline at end of file
+app = App(app_ui, server, static_assets=www_dir)
+
+#with HIPPOCAMPUS_VIEWER_METRICS=1, timings and cache counters are served 
+#on /metrics next to the app
+if METRICS_ENABLED:
+    async def metrics(request):
+        return PlainTextResponse(
+            render_metrics(), media_type="text/plain; version=0.0.4"
+        )
+
+    app = Starlette(routes=[
+        Route("/metrics", metrics),
+        Mount("/", app=app),
+    ])
\ No newline at end of file
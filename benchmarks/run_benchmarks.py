@@ -0,0 +1,315 @@
+"""
+Benchmarks for the data loaders, mesh kernels and figure builders. Reports
+wall time, peak traced memory and serialized payload size per case and
+compares them against a saved baseline.
+
+Run from the repository root:
+
+    python -m benchmarks.run_benchmarks --output baseline.json
+    python -m benchmarks.run_benchmarks --baseline baseline.json
+
+The mesh kernels run on synthetic tube meshes of the given vertex counts,
+loaders and figure builders on scratch copies of the subject data in
+--datpath, or with --synthetic on a generated cohort of as many subjects as
+the largest --subjects value. Loaders are timed on cohorts of every
+--subjects size, with cold data caches, which parse all sources, and with
+warm ones. Scratch copies and derived assets go into a temporary folder
+that is removed afterwards. The exit code is 1 if any case regressed by
+more than --tolerance against the baseline.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import plotly.graph_objects as go
+from plotly.serializers import _py_to_js
+
+from data.data_loader import (
+    datpath, load_surface_data, load_depth_data, SurfaceDataset, DepthDataset,
+    subject_folders
+)
+from data.synthetic import tube_mesh, write_cohort
+from utils import utils, cache_helper
+from utils.plot_helper import (
+    create_surface_plot, create_line_plot, create_overlay_file
+)
+
+
+def payload_size(obj) -> int:
+    """
+    Bytes the FigureWidget serializer sends for a figure (or the length of
+    encoded files): binary buffers by their length, the rest as JSON
+    """
+    if isinstance(obj, bytes):
+        return len(obj)
+    if not isinstance(obj, (go.Figure, go.FigureWidget)):
+        return 0
+
+    n_buffer = 0
+    def strip(v):
+        nonlocal n_buffer
+        if isinstance(v, dict):
+            if isinstance(v.get("buffer"), memoryview):
+                n_buffer += v["buffer"].nbytes
+                return {key: val for key, val in v.items() if key != "buffer"}
+            return {key: strip(val) for key, val in v.items()}
+        if isinstance(v, list):
+            return [strip(val) for val in v]
+        return v
+    spec = strip(_py_to_js(obj.to_dict(), None))
+    return n_buffer + len(json.dumps(spec, default=str))
+
+
+def measure(func, repeat: int, setup=None) -> dict:
+    """
+    Median wall time over repeat calls of func, followed by one call under
+    tracemalloc for the peak memory. setup runs untimed before every call
+    """
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "time_s": statistics.median(times),
+        "peak_mb": peak / 2**20,
+        "payload_bytes": payload_size(result),
+    }
+
+
+def clear_caches():
+    """
+    Drops all in-process caches, so every call measures a cold build.
+    Assets on disk are kept, as in a deployed app
+    """
+    utils._adjacency_cache.clear()
+    cache_helper._assets.clear()
+    cache_helper._figures.clear()
+    cache_helper._overlay_files.clear()
+
+
+def scratch_copy(path: str, root: str, subjects=None) -> str:
+    """
+    Folder in root linking to everything in path except the data caches,
+    so loaders can be timed on cold caches without touching path. With 
+    subjects, only the folders of these subjects are linked
+    """
+    scratch = tempfile.mkdtemp(dir=root)
+    folders = {os.path.basename(folder.rstrip("/")) for folder in subject_folders(path)}
+    for name in os.listdir(path):
+        if name == "surface_store" or name.startswith("depth_data.npz"):
+            continue
+        if subjects is not None and name in folders and name not in subjects:
+            continue
+        os.symlink(os.path.join(os.path.abspath(path), name), os.path.join(scratch, name))
+    return scratch
+
+
+def drop_data_caches(path: str):
+    """
+    Deletes the surface store and the depth cache in path
+    """
+    shutil.rmtree(os.path.join(path, "surface_store"), ignore_errors=True)
+    for name in os.listdir(path):
+        if name.startswith("depth_data.npz"):
+            os.remove(os.path.join(path, name))
+
+
+def kernel_cases(sizes):
+    """
+    (name, function, setup) of the mesh kernel benchmarks
+    """
+    for n_vertices in sizes:
+        vertices, faces, labels = tube_mesh(n_vertices)
+        cdata = np.random.default_rng(0).normal(size=len(vertices))
+        yield (f"surfdat_smooth[{n_vertices}]",
+               lambda faces=faces, cdata=cdata: utils.surfdat_smooth(faces, cdata),
+               clear_caches)
+        yield (f"create_border_coordinates[{n_vertices}]",
+               lambda faces=faces, vertices=vertices, labels=labels:
+                   utils.create_border_coordinates(faces, vertices, labels),
+               clear_caches)
+
+
+def loader_cases(path: str, label: str, workers: int):
+    """
+    (name, function, setup) of the loaders on path, timed on cold caches,
+    which parse all sources, and on warm caches, which only open them
+    """
+    def cold():
+        clear_caches()
+        drop_data_caches(path)
+
+    def warm():
+        clear_caches()
+        load_surface_data(path, workers)
+        load_depth_data(path, workers)
+
+    for loader in [load_surface_data, load_depth_data]:
+        yield (f"{loader.__name__}[{label}cold]",
+               lambda loader=loader: loader(path, workers), cold)
+        yield (f"{loader.__name__}[{label}warm]",
+               lambda loader=loader: loader(path, workers), warm)
+
+
+def dataset_cases(path: str, subject_counts, workers: int, root: str):
+    """
+    (name, function, setup) of the loader and figure benchmarks on the data
+    in path. Everything runs on scratch copies of path in root. Loaders run
+    on the first n subjects (and avg) for every n in subject_counts, figures
+    on all subjects
+    """
+    scratch = scratch_copy(path, root)
+
+    folders = sorted(os.path.basename(folder.rstrip("/")) for folder in subject_folders(path))
+    subjects = [s for s in folders if s != "avg"]
+    if folders:
+        for n_subjects in subject_counts:
+            if n_subjects > len(subjects):
+                continue
+            selection = subjects[:n_subjects] + [s for s in folders if s == "avg"]
+            yield from loader_cases(
+                scratch_copy(path, root, selection), f"{n_subjects},", workers
+            )
+    else:
+        # legacy caches without subject folders cannot be subset
+        yield from loader_cases(scratch, "", workers)
+
+    surface_data = SurfaceDataset(datpath=scratch, workers=workers)
+    if surface_data.subjects:
+        subject = surface_data.subjects[0]
+        for lod in [0, "auto"]:
+            yield (f"create_surface_plot[{subject},lod={lod}]",
+                   lambda lod=lod: create_surface_plot(surface_data, subject, "T2s", "inner",
+                                                       False, True, lod=lod),
+                   clear_caches)
+        yield (f"create_overlay_file[{subject}]",
+               lambda: create_overlay_file(surface_data, subject, "inner", "T2s"),
+               clear_caches)
+
+    depth_data = DepthDataset(datpath=scratch, workers=workers)
+    subjects = [s for s in depth_data.subjects if s != "avg"]
+    for n_subjects in subject_counts:
+        if n_subjects > len(subjects):
+            continue
+        selection = subjects[:n_subjects]
+        for consolidated in [False, True]:
+            yield (f"create_line_plot[{n_subjects},consolidated={consolidated}]",
+                   lambda selection=selection, consolidated=consolidated:
+                   create_line_plot(depth_data, selection, "T2s", "breathhold",
+                                    False, consolidated=consolidated),
+                   clear_caches)
+
+
+def compare(results: dict, baseline: dict, tolerance: float):
+    """
+    Cases whose time, peak memory or payload grew by more than tolerance
+    (relative) compared to baseline
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric, value in result.items():
+            reference = baseline[name].get(metric)
+            if reference and value > reference * (1 + tolerance):
+                regressions.append((name, metric, reference, value))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--datpath", default=datpath, help="folder holding the subject data"
+    )
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[5000, 20000, 80000],
+        help="vertex counts of the synthetic meshes"
+    )
+    parser.add_argument(
+        "--subjects", type=int, nargs="+", default=[1, 10, 30],
+        help="numbers of subjects loaded and shown in the line plot"
+    )
+    parser.add_argument(
+        "--synthetic", action="store_true",
+        help="run on a generated cohort instead of --datpath"
+    )
+    parser.add_argument(
+        "--synthetic-vertices", type=int, default=10000,
+        help="vertices per surface of the generated cohort"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="timed calls per case"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="number of loader processes"
+    )
+    parser.add_argument(
+        "--filter", default="", help="only run cases whose name contains this"
+    )
+    parser.add_argument(
+        "--output", default=None, help="write the results as JSON to this file"
+    )
+    parser.add_argument(
+        "--baseline", default=None, help="JSON results to compare against"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.2,
+        help="allowed relative increase over the baseline"
+    )
+    args = parser.parse_args()
+
+    # cohorts, scratch copies and assets all go into one temporary folder,
+    # the app's data and artifacts are not touched
+    with tempfile.TemporaryDirectory() as root:
+        cache_helper.artifact_dir = os.path.join(root, "artifacts")
+        path = args.datpath
+        if args.synthetic:
+            path = os.path.join(root, "cohort")
+            write_cohort(path, max(args.subjects), args.synthetic_vertices)
+
+        cases = list(kernel_cases(args.sizes))
+        cases += list(dataset_cases(path, args.subjects, args.workers, root))
+
+        results = {}
+        for name, func, setup in cases:
+            if args.filter not in name:
+                continue
+            results[name] = measure(func, args.repeat, setup=setup)
+            result = results[name]
+            print(f"{name:<50} {result['time_s']*1000:10.1f} ms "
+                  f"{result['peak_mb']:9.1f} MB {result['payload_bytes']/1024:10.1f} kB")
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, metric, reference, value in regressions:
+            print(f"REGRESSION {name} {metric}: {reference:.4g} -> {value:.4g}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
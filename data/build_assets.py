@@ -0,0 +1,126 @@
+"""
+Precomputes all derived surface assets (borders, hover data, colorscales,
+decimated meshes) for every subject x layer x folded/unfolded view and writes them into the
+versioned artifact directory, so the served app only has to load them.
+The surface store and the depth cache are brought up to date first, which
+the app otherwise does on first data access.
+
+Run from the repository root:
+
+    python -m data.build_assets --workers 4
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from data.data_loader import (
+    datpath, SurfaceDataset, update_surface_store, load_depth_data
+)
+from utils import cache_helper
+from utils.plot_helper import colormaps, surface_colorscale, surface_mesh, LOD_LEVELS
+
+
+def _set_artifact_dir(out: str):
+    cache_helper.artifact_dir = out
+
+
+def build_mesh_assets(vertices, faces, labels):
+    """
+    Computes and writes the assets of a single mesh and its levels of detail
+    """
+    borders = cache_helper.load_border_coordinates(faces, vertices, labels)
+    cache_helper.load_subfield_names(labels)
+    n_vertices = [len(vertices)]
+    for level in range(1, LOD_LEVELS):
+        lod = cache_helper.load_mesh_lod(faces, vertices, labels, level)
+        cache_helper.load_border_coordinates(lod["faces"], lod["vertices"], lod["labels"])
+        cache_helper.load_subfield_names(lod["labels"])
+        n_vertices.append(len(lod["vertices"]))
+    return {
+        "border_points": sum(len(val) for val in borders.values()),
+        "lod_vertices": n_vertices,
+    }
+
+
+def list_views(surface_data):
+    """
+    All (subject, layer, unfolded) combinations that can be shown
+    """
+    views = []
+    for subject in surface_data.subjects:
+        for Layer in ["inner", "outer"]:
+            if Layer not in surface_data.layers(subject):
+                continue
+            for unfolded in [False, True]:
+                views.append((subject, Layer, unfolded))
+    return views
+
+
+def build_assets(surface_data, out: str = None, workers: int = None):
+    """
+    Writes the assets of all views of surface_data into out, which defaults
+    to the artifact directory of the current asset version
+    """
+    out = cache_helper.artifact_dir if out is None else out
+    os.makedirs(out, exist_ok=True)
+
+    colorscales = {
+        key: surface_colorscale(key) for key in colormaps if key != "Subfields"
+    }
+    with open(os.path.join(out, "colorscales.json"), "w") as file:
+        json.dump(colorscales, file)
+
+    # views sharing a mesh (e.g. unfolded inner/outer) are only built once
+    meshes = {}
+    for subject, Layer, unfolded in list_views(surface_data):
+        vertices, faces, labels = surface_mesh(surface_data, subject, Layer, unfolded)
+        key = cache_helper.content_hash(faces, vertices, labels)
+        meshes.setdefault(key, (vertices, faces, labels))
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_set_artifact_dir, initargs=(out,)
+    ) as pool:
+        futures = {
+            key: pool.submit(build_mesh_assets, *mesh) for key, mesh in meshes.items()
+        }
+        mesh_info = {key: future.result() for key, future in futures.items()}
+
+    manifest = {
+        "version": cache_helper.ASSET_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "subjects": surface_data.subjects,
+        "meshes": mesh_info,
+    }
+    with open(os.path.join(out, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--datpath", default=datpath, help="folder holding the subject data"
+    )
+    parser.add_argument(
+        "--out", default=None, help="artifact directory, defaults to the current asset version"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="number of worker processes"
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    update_surface_store(args.datpath, args.workers)
+    load_depth_data(args.datpath, args.workers)
+    surface_data = SurfaceDataset(datpath=args.datpath, workers=args.workers)
+    manifest = build_assets(surface_data, out=args.out, workers=args.workers)
+    print(
+        f"built assets for {len(manifest['meshes'])} meshes of "
+        f"{len(manifest['subjects'])} subjects in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
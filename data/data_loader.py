@@ -4,231 +4,768 @@ import glob
 import nibabel as nib
 import os
 import json
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 
-def load_surface_data(datpath: str):
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from utils.metrics_helper import timed
+
+SURFACE_STORE_VERSION = 1
+DEPTH_OVERLAYS = ["dSbreathhold", "dSbreathhold_weighted", "T2s", "beta", "tSNR"]
+#upper bound of array bytes referenced by the lazy surface dataset
+SURFACE_CACHE_BYTES = 2 * 1024**3
+#default number of processes parsing subject folders
+LOADER_WORKERS = min(8, os.cpu_count() or 1)
+#mkstemp creates files readable by their owner only, written files get the
+#permissions of a regular file instead, so other users can read them
+_umask = os.umask(0)
+os.umask(_umask)
+
+Mesh = namedtuple("Mesh", ["vertices", "faces"])
+
+
+def subject_folders(datpath: str):
     """
-    Loads surface data into dataframe
+    Folders in datpath holding data of a subject, skipping caches and 
+    other folders next to them
     """
+    folders = glob.glob(datpath + "/*/")
+    return [
+        x for x in folders
+        if any(os.path.isdir(x + sub) for sub in ["breathhold", "memory", "hippunfold"])
+    ]
 
-    if os.path.isfile(datpath + "/surface_data.pkl"):
-        wide = pd.read_pickle(datpath + '/surface_data.pkl')
-    else:
-        folders = glob.glob(datpath + "/*/")
 
-        df_list = []
-        for idx, folder in enumerate(folders):
-            subject = os.path.basename(folder.rstrip("/"))
-
-            # loop over files in breath-hold dir
-            BH_files = glob.glob(folder + "breathhold/*.gii")
-            BH_files = [x for x in BH_files if "_stdev_" not in x]
-            if BH_files:
-                for BH_file in BH_files:
-                    dat = nib.load(BH_file).darrays[0].data.reshape(-1, 1)
-                    Overlay = BH_file.split("_", 3)[-1].split(".shape", 1)[0]
-                    Layer = "inner" if "inner" in BH_file else "outer"
-                    out = {
-                        "Subject": subject,
-                        "Layer": Layer,
-                        "Overlay": Overlay,
-                        "Data": dat,
-                    }
-                    df_list.append(out)
-
-            # loop over files in memory dir
-            mem_files = glob.glob(folder + "memory/native/*.gii")
-            if (subject == "7495") | (subject == "7566"):
-                mem_files = glob.glob(folder + "memory/ses-01/native/*.gii")
-            elif subject == "avg":
-                mem_files = glob.glob(folder + "memory/*.gii")
-            mem_files = [
-                x for x in mem_files if "tSNR" in x and "_stdev_" not in x
-            ]
-            for mem_file in mem_files:
-                dat = nib.load(mem_file).darrays[0].data.reshape(-1, 1)
-                Overlay = mem_file.split("_", 3)[-1].split(".shape", 1)[0]
-                Layer = "inner" if "inner" in mem_file else "outer"
-                out = {
-                    "Subject": subject,
-                    "Layer": Layer,
-                    "Overlay": Overlay,
-                    "Data": dat,
-                }
-                df_list.append(out)
+def _as_mesh(darrays):
+    """
+    Returns vertices and faces of a GIfTI surface. Arrays are identified by
+    their intent, falling back to faces first and vertices second
+    """
+    intents = {da.intent: da.data for da in darrays}
+    pointset = nib.nifti1.intent_codes["NIFTI_INTENT_POINTSET"]
+    triangle = nib.nifti1.intent_codes["NIFTI_INTENT_TRIANGLE"]
+    if pointset in intents and triangle in intents:
+        return Mesh(vertices=intents[pointset], faces=intents[triangle])
+    return Mesh(vertices=darrays[1].data, faces=darrays[0].data)
+
+
+def _as_cell(dat):
+    """
+    Converts cells of legacy surface_data.pkl files holding GiftiDataArrays
+    """
+    if isinstance(dat, list):
+        if len(dat) == 1:
+            return dat[0].data
+        return _as_mesh(dat)
+    return dat
 
-            # loop over files in hippunfold dir
-            if subject == "avg":
-                struct_files_base = glob.glob(folder + "hippunfold/*.gii")
-                struct_files = [
-                    x
-                    for x in struct_files_base
-                    if "hemi-L" in x
-                    and ".surf" in x
-                    and "midthickness" not in x
-                    and "atlas-bigbrain" not in x
-                    and "stdev" not in x
-                ]
-            else:
-                struct_files_base = glob.glob(folder + "hippunfold/surf/*.gii")
-                struct_files = [
-                    x
-                    for x in struct_files_base
-                    if "hemi-L" in x
-                    and "label-hipp" in x
-                    and "space-T2w" in x
-                    and ".surf" in x
-                    and "midthickness" not in x
-                    and "atlas-bigbrain" not in x
-                ]
-            struct_files.append([x for x in struct_files_base if "atlas-bigbrain_subfields.label" in x and "hemi-L" in x][0])
-            
-            for struct_file in struct_files:
-                if ".label" in struct_file:
-                    dat = nib.load(struct_file).darrays
-                    Overlay = "Labels"
-                    Layer = "Canonical"
-                else:   
-                    dat = nib.load(struct_file).darrays[0:2]
-                    if subject == "avg":
-                        Overlay = struct_file.split(".", 3)[-3]
-                    else:
-                        Overlay = "native"
-                    Layer = "inner" if "inner" in struct_file else "outer"
-                    
-                out = {
-                    "Subject": subject,
-                    "Layer": Layer,
-                    "Overlay": Overlay,
-                    "Data": dat,
-                }
-                df_list.append(out)
 
-        df = pd.DataFrame(
-            df_list, columns=["Subject", "Layer", "Overlay", "Data"]
+def _table_records(wide):
+    """
+    Converts the wide table back to records of the long format table
+    """
+    df_list = []
+    for (subject, Layer), row in wide.iterrows():
+        for Overlay, dat in row.items():
+            if isinstance(dat, (Mesh, np.ndarray)):
+                df_list.append(
+                    {"Subject": subject, "Layer": Layer, "Overlay": Overlay, "Data": dat}
+                )
+    return df_list
+
+
+@contextmanager
+def _file_lock(fname: str):
+    """
+    Exclusive lock on fname held by one process at a time, serializing 
+    rebuilds of the data caches. Without fcntl rebuilds are not serialized
+    """
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, "a") as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def _write_surface_records(store: str, df_list, generation: str):
+    """
+    Writes every record as contiguous .npy array(s) into the folder of
+    generation and returns the index entries pointing to them. Arrays are
+    never overwritten, so processes mapping older generations are not 
+    affected
+    """
+    entries = []
+    for out in df_list:
+        subject, Layer, Overlay, dat = (
+            out["Subject"], out["Layer"], out["Overlay"], out["Data"]
         )
-        # From long to wide format
-        wide = df.pivot(
-            index=["Subject", "Layer"], columns="Overlay", values="Data"
+        base = os.path.join(subject, generation, Layer, Overlay)
+        os.makedirs(os.path.join(store, subject, generation, Layer), exist_ok=True)
+        if isinstance(dat, Mesh):
+            files = {
+                "vertices": base + ".vertices.npy",
+                "faces": base + ".faces.npy",
+            }
+            arrays = {"vertices": dat.vertices, "faces": dat.faces}
+        else:
+            files = {"data": base + ".npy"}
+            arrays = {"data": dat}
+        for key, fname in files.items():
+            np.save(os.path.join(store, fname), np.ascontiguousarray(arrays[key]))
+        entries.append(
+            {"Subject": subject, "Layer": Layer, "Overlay": Overlay, "files": files}
         )
-        
-        wide["Borders"] = None
+    return entries
 
-        wide.to_pickle(datpath + '/surface_data.pkl')
-    return wide
+
+def _read_surface_index(store: str):
+    fname = os.path.join(store, "index.json")
+    if not os.path.isfile(fname):
+        return None
+    with open(fname) as file:
+        index = json.load(file)
+    if index.get("version") != SURFACE_STORE_VERSION:
+        return None
+    return index
+
+
+def _write_surface_index(store: str, entries, sources):
+    """
+    The index is written last and atomically, so readers never see entries
+    whose arrays are incomplete
+    """
+    index = {"version": SURFACE_STORE_VERSION, "entries": entries, "sources": sources}
+    os.makedirs(store, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=store, prefix="index.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as file:
+            json.dump(index, file)
+        os.chmod(tmp, 0o644 & ~_umask)
+        os.replace(tmp, os.path.join(store, "index.json"))
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _drop_generations(store: str, subject: str, keep: str = None):
+    """
+    Deletes all arrays of a subject except those of generation keep
+    """
+    folder = os.path.join(store, subject)
+    if not os.path.isdir(folder):
+        return
+    for name in os.listdir(folder):
+        if name == keep:
+            continue
+        path = os.path.join(folder, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+    if not os.listdir(folder):
+        os.rmdir(folder)
+
+
+def source_manifest(folder: str, suffix: str):
+    """
+    Path, size and modification time of all source files of a subject
+    """
+    manifest = {}
+    for root, _, files in os.walk(folder):
+        for fname in files:
+            if fname.endswith(suffix):
+                path = os.path.join(root, fname)
+                stat = os.stat(path)
+                manifest[os.path.relpath(path, folder)] = [stat.st_size, stat.st_mtime_ns]
+    return manifest
+
+
+def _stale_subjects(folders: dict, cached_sources: dict, suffix: str):
+    """
+    Compares the sources the cache was built from with the current ones.
+    Returns the current manifest, the subjects to (re-)parse and the 
+    subjects to drop from the cache
+    """
+    sources = {
+        subject: source_manifest(folder, suffix) for subject, folder in folders.items()
+    }
+    changed = [s for s in sorted(sources) if cached_sources.get(s) != sources[s]]
+    removed = [s for s in sorted(cached_sources) if s not in sources]
+    return sources, changed, removed
+
+
+def _parse_subjects(parse, folders: dict, subjects: list, workers: int = None):
+    """
+    Applies parse to the folders of subjects in a process pool. Results are
+    returned in the order of subjects, independent of completion order.
+    """
+    workers = LOADER_WORKERS if workers is None else workers
+    paths = [folders[subject] for subject in subjects]
+    if workers <= 1 or len(paths) <= 1:
+        return [parse(path) for path in paths]
+    with ProcessPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+        return list(pool.map(parse, paths))
+
+
+def update_surface_store(datpath: str, workers: int = None):
+    """
+    Brings the surface store in datpath/surface_store up to date with the
+    GIfTI files. Only new or changed subjects are parsed again, in parallel
+    by up to workers processes, subjects whose folders were removed are
+    dropped. Without any subject folders the store is used as is, migrating
+    a legacy surface_data.pkl if needed.
+    """
+    store = os.path.join(datpath, "surface_store")
+    folders = {
+        os.path.basename(folder.rstrip("/")): folder
+        for folder in subject_folders(datpath)
+    }
+
+    if not folders:
+        if _read_surface_index(store) is None and os.path.isfile(datpath + "/surface_data.pkl"):
+            with _file_lock(os.path.join(store, ".lock")):
+                if _read_surface_index(store) is None:
+                    wide = pd.read_pickle(datpath + '/surface_data.pkl').map(_as_cell)
+                    wide = wide.drop(columns="Borders", errors="ignore")
+                    entries = _write_surface_records(
+                        store, _table_records(wide), uuid.uuid4().hex
+                    )
+                    _write_surface_index(store, entries, None)
+        return store
+
+    # processes starting on a stale store wait for the first one to rebuild
+    # it and then find it up to date
+    with _file_lock(os.path.join(store, ".lock")):
+        index = _read_surface_index(store)
+        if index is None:
+            index = {"entries": [], "sources": {}}
+        if index["sources"] is None:
+            # a store without manifest cannot be checked, all subjects are stale
+            index["sources"] = {e["Subject"]: None for e in index["entries"]}
+        sources, changed, removed = _stale_subjects(folders, index["sources"], ".gii")
+        if not changed and not removed:
+            return store
+
+        # all subjects are parsed before the store is touched, so a failing
+        # subject leaves it as it was
+        parsed = _parse_subjects(_parse_surface_subject, folders, changed, workers)
+        generation = uuid.uuid4().hex
+        entries = [e for e in index["entries"] if e["Subject"] not in changed + removed]
+        try:
+            for df_list in parsed:
+                entries.extend(_write_surface_records(store, df_list, generation))
+            _write_surface_index(store, entries, sources)
+        except BaseException:
+            for subject in changed:
+                shutil.rmtree(os.path.join(store, subject, generation), ignore_errors=True)
+            raise
+
+        # old arrays are deleted once the new index is in place, processes
+        # that mapped them keep reading them until they are closed
+        for subject in changed + removed:
+            _drop_generations(store, subject, keep=generation)
+    return store
+
+
+def _open_entry(store: str, entry: dict):
+    """
+    Memory-maps the array(s) of a single index entry read-only
+    """
+    arrays = {
+        key: np.load(os.path.join(store, fname), mmap_mode="r")
+        for key, fname in entry["files"].items()
+    }
+    return Mesh(**arrays) if "faces" in arrays else arrays["data"]
+
+
+def open_surface_store(store: str):
+    """
+    Opens a surface store as wide table. Arrays are memory-mapped read-only,
+    so pages are shared between processes and only read when touched.
+    """
+    index = _read_surface_index(store) or {"entries": []}
+
+    df_list = []
+    for entry in index["entries"]:
+        df_list.append(
+            {
+                "Subject": entry["Subject"],
+                "Layer": entry["Layer"],
+                "Overlay": entry["Overlay"],
+                "Data": _open_entry(store, entry),
+            }
+        )
+
+    df = pd.DataFrame(df_list, columns=["Subject", "Layer", "Overlay", "Data"])
+    return df.pivot(index=["Subject", "Layer"], columns="Overlay", values="Data")
 
 
-def load_depth_data(datpath: str):
+def _parse_surface_subject(folder: str):
     """
-    Loads data as a function of cortical depth
+    Parses the surface GIfTI files of a single subject folder into records
+    of the long format table
     """
-    if os.path.isfile(datpath + "/depth_data.pkl"):
-        wide = pd.read_pickle(datpath + '/depth_data.pkl')
+    df_list = []
+    subject = os.path.basename(folder.rstrip("/"))
+
+    # loop over files in breath-hold dir
+    BH_files = glob.glob(folder + "breathhold/*.gii")
+    BH_files = [x for x in BH_files if "_stdev_" not in x]
+    if BH_files:
+        for BH_file in BH_files:
+            dat = nib.load(BH_file).darrays[0].data.reshape(-1, 1)
+            fname = os.path.basename(BH_file)
+            Overlay = fname.split("_", 3)[-1].split(".shape", 1)[0]
+            Layer = "inner" if "inner" in fname else "outer"
+            out = {
+                "Subject": subject,
+                "Layer": Layer,
+                "Overlay": Overlay,
+                "Data": dat,
+            }
+            df_list.append(out)
+
+    # loop over files in memory dir
+    mem_files = glob.glob(folder + "memory/native/*.gii")
+    if (subject == "7495") | (subject == "7566"):
+        mem_files = glob.glob(folder + "memory/ses-01/native/*.gii")
+    elif subject == "avg":
+        mem_files = glob.glob(folder + "memory/*.gii")
+    mem_files = [
+        x for x in mem_files if "tSNR" in x and "_stdev_" not in x
+    ]
+    for mem_file in mem_files:
+        dat = nib.load(mem_file).darrays[0].data.reshape(-1, 1)
+        fname = os.path.basename(mem_file)
+        Overlay = fname.split("_", 3)[-1].split(".shape", 1)[0]
+        Layer = "inner" if "inner" in fname else "outer"
+        out = {
+            "Subject": subject,
+            "Layer": Layer,
+            "Overlay": Overlay,
+            "Data": dat,
+        }
+        df_list.append(out)
+
+    # loop over files in hippunfold dir
+    if subject == "avg":
+        struct_files_base = glob.glob(folder + "hippunfold/*.gii")
+        struct_files = [
+            x
+            for x in struct_files_base
+            if "hemi-L" in x
+            and ".surf" in x
+            and "midthickness" not in x
+            and "atlas-bigbrain" not in x
+            and "stdev" not in x
+        ]
     else:
-        folders = glob.glob(datpath + "/*/")
-        df_list = []
-        for idx, folder in enumerate(folders):
-            subject = os.path.basename(folder.rstrip("/"))
-            # loop over files in breath-hold dir
-            BH_files = glob.glob(folder + "breathhold/*.json")
-            if BH_files:
-                for BH_file in BH_files:
-                    with open(BH_file) as file:
-                        dat = json.load(file)
-                        
-                    if "avg" in folder:
-                        tmp = dat["T2s_submean"]
-                        inp = ["T2s_submean","dS_mean_echo_submean","dS_mean_echo_weighted_submean"]
-                    else:
-                        tmp = dat["R2s"]
-                        inp = ["R2s","dS_mean_echo","dS_mean_echo_weighted"]
-                        
-                    T2s = np.zeros((len(tmp), len(tmp[0])))
-                    dSbreathhold = np.zeros((len(tmp), len(tmp[0])))
-                    dSbreathhold_weighted = np.zeros((len(tmp), len(tmp[0])))
-    
-                    for depth in range(len(tmp)):
-                        for subfield in range(len(tmp[0])):
-                            if "avg" in folder:
-                                T2s[depth, subfield] = dat[inp[0]][depth][subfield]
-                            else:
-                                T2s[depth, subfield] = dat[inp[0]][depth][subfield][0]                            
-                            dSbreathhold[depth, subfield] = dat[inp[1]][depth][subfield]
-                            dSbreathhold_weighted[depth, subfield] = dat[inp[2]][depth][subfield]
+        struct_files_base = glob.glob(folder + "hippunfold/surf/*.gii")
+        struct_files = [
+            x
+            for x in struct_files_base
+            if "hemi-L" in x
+            and "label-hipp" in x
+            and "space-T2w" in x
+            and ".surf" in x
+            and "midthickness" not in x
+            and "atlas-bigbrain" not in x
+        ]
+    struct_files.append([x for x in struct_files_base if "atlas-bigbrain_subfields.label" in x and "hemi-L" in x][0])
     
-                    if "avg" not in folder:
-                        T2s = (1 / T2s) * 1000
-                        
-                    out = {
-                        "Subject": subject,
-                        "dSbreathhold": dSbreathhold,
-                        "dSbreathhold_weighted": dSbreathhold_weighted,
-                        "T2s": T2s,
-                        }
-    
-                    df_list.append(out)
+    for struct_file in struct_files:
+        fname = os.path.basename(struct_file)
+        if ".label" in fname:
+            dat = nib.load(struct_file).darrays[0].data
+            Overlay = "Labels"
+            Layer = "Canonical"
+        else:   
+            dat = _as_mesh(nib.load(struct_file).darrays)
+            if subject == "avg":
+                Overlay = fname.split(".", 3)[-3]
+            else:
+                Overlay = "native"
+            Layer = "inner" if "inner" in fname else "outer"
+            
+        out = {
+            "Subject": subject,
+            "Layer": Layer,
+            "Overlay": Overlay,
+            "Data": dat,
+        }
+        df_list.append(out)
+    return df_list
+
+
+@timed()
+def load_surface_data(datpath: str, workers: int = None):
+    """
+    Loads surface data into dataframe. Data are read from the memory-mapped
+    store in datpath/surface_store, which is updated from the GIfTI files
+    first using up to workers processes.
+    """
+    return open_surface_store(update_surface_store(datpath, workers))
+
+
+def _parse_depth_subject(folder: str):
+    """
+    Parses the depth profile JSON files of a single subject folder into
+    table rows
+    """
+    df_list = []
+    subject = os.path.basename(folder.rstrip("/"))
+    # loop over files in breath-hold dir
+    BH_files = sorted(glob.glob(folder + "breathhold/*.json"))
+    if BH_files:
+        for BH_file in BH_files:
+            with open(BH_file) as file:
+                dat = json.load(file)
+                
+            # arrays are depth x subfield, R2* of single subjects carries
+            # an extra trailing dimension
+            if "avg" in folder:
+                inp = ["T2s_submean","dS_mean_echo_submean","dS_mean_echo_weighted_submean"]
+                T2s = np.asarray(dat[inp[0]], dtype=float)
+            else:
+                inp = ["R2s","dS_mean_echo","dS_mean_echo_weighted"]
+                T2s = np.asarray(dat[inp[0]], dtype=float)[:, :, 0]
+            dSbreathhold = np.asarray(dat[inp[1]], dtype=float)
+            dSbreathhold_weighted = np.asarray(dat[inp[2]], dtype=float)
     
-            # loop over files in memory dir
-            mem_files = glob.glob(folder + "memory/z_transformed/*.json")
-            if (subject == "7495") | (subject == "7566"):
-                mem_files = glob.glob(
-                    folder + "memory/ses-01/z_transformed/*.json"
-                )
-            elif (subject == "avg"):
-                mem_files = glob.glob(folder + "memory/*.json")
-            mem_files = [
-                x
-                for x in mem_files
-                if ("memory_vs_math" or "pre_vs_post" in x) and "unfolded" not in x
-            ]
-            if subject != "avg":
-                mem_files = [mem_files[ii] for ii in [0, 1, 4, 5]]
-            for mem_file in mem_files:
-                with open(mem_file) as file:
-                    dat = json.load(file)
+            if "avg" not in folder:
+                T2s = (1 / T2s) * 1000
+                
+            out = {
+                "Subject": subject,
+                "dSbreathhold": dSbreathhold,
+                "dSbreathhold_weighted": dSbreathhold_weighted,
+                "T2s": T2s,
+                "vessel_masked": False,
+                "contrast": "breathhold",
+                }
     
-                vessel_masked = True if "vessel_masked" in mem_file else False
-                contrast = (
-                    "memory_vs_math"
-                    if "memory_vs_math" in mem_file
-                    else "pre_vs_post"
-                )
-                tmp = dat["con_array"]
-                beta = np.zeros((len(tmp), len(tmp[0]))).T
-                tSNR = np.zeros((len(tmp), len(tmp[0]))).T
+            df_list.append(out)
     
-                for subfield in range(len(tmp)):
-                    beta[:, subfield] = dat["con_array"][subfield]
-                    tSNR[:, subfield] = dat["tSNR"][subfield]
+    # loop over files in memory dir
+    mem_files = glob.glob(folder + "memory/z_transformed/*.json")
+    if (subject == "7495") | (subject == "7566"):
+        mem_files = glob.glob(
+            folder + "memory/ses-01/z_transformed/*.json"
+        )
+    elif (subject == "avg"):
+        mem_files = glob.glob(folder + "memory/*.json")
+    # the two contrasts, each with and without vessel masking
+    mem_files = [
+        x
+        for x in sorted(mem_files)
+        if ("memory_vs_math" in x or "pre_vs_post" in x) and "unfolded" not in x
+    ]
+    for mem_file in mem_files:
+        with open(mem_file) as file:
+            dat = json.load(file)
     
-                out = {
-                    "Subject": subject,
-                    "beta": beta,
-                    "tSNR": tSNR,
-                    "vessel_masked": vessel_masked,
-                    "contrast": contrast,
-                }
+        vessel_masked = True if "vessel_masked" in mem_file else False
+        contrast = (
+            "memory_vs_math"
+            if "memory_vs_math" in mem_file
+            else "pre_vs_post"
+        )
+        # stored as subfield x depth
+        beta = np.asarray(dat["con_array"], dtype=float).T
+        tSNR = np.asarray(dat["tSNR"], dtype=float).T
     
-                df_list.append(out)
-        
-        wide = pd.DataFrame(
-            df_list, columns=[
-                "Subject", 
-                "dSbreathhold", 
-                "dSbreathhold_weighted", 
-                "T2s",
-                "beta",
-                "tSNR",
-                "vessel_masked",
-                "contrast"])
-        wide["contrast"].fillna("breathhold",inplace=True)
-        wide["vessel_masked"].fillna(False,inplace=True)
-        wide = wide.set_index(["Subject","contrast","vessel_masked"])
-        
+        out = {
+            "Subject": subject,
+            "beta": beta,
+            "tSNR": tSNR,
+            "vessel_masked": vessel_masked,
+            "contrast": contrast,
+        }
     
-        wide.to_pickle(datpath + '/depth_data.pkl')
+        df_list.append(out)
+    return df_list
+
+
+def _depth_table(df_list):
+    wide = pd.DataFrame(
+        df_list, columns=["Subject"] + DEPTH_OVERLAYS + ["vessel_masked", "contrast"]
+    )
+    wide = wide.set_index(["Subject","contrast","vessel_masked"])
+    return wide
+
+
+def _write_depth_cache(fname: str, wide):
+    """
+    Stores the depth table as .npz with one float array per cell, keyed
+    subject/contrast/vessel_masked/overlay, plus the source manifest
+    """
+    arrays = {}
+    for (subject, contrast, vessel_masked), row in wide.iterrows():
+        for Overlay, dat in row.items():
+            if isinstance(dat, np.ndarray):
+                arrays[f"{subject}/{contrast}/{vessel_masked}/{Overlay}"] = dat
+    arrays["sources"] = np.array(json.dumps(wide.attrs.get("sources")))
+
+    fd, tmp = tempfile.mkstemp(
+        dir=os.path.dirname(fname), prefix=os.path.basename(fname) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as file:
+            np.savez_compressed(file, **arrays)
+        os.chmod(tmp, 0o644 & ~_umask)
+        os.replace(tmp, fname)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _read_depth_cache(fname: str):
+    rows = {}
+    with np.load(fname) as file:
+        sources = json.loads(str(file["sources"]))
+        for key in file.files:
+            if key == "sources":
+                continue
+            subject, contrast, vessel_masked, Overlay = key.split("/")
+            row = rows.setdefault(
+                (subject, contrast, vessel_masked == "True"),
+                {"Subject": subject, "contrast": contrast, "vessel_masked": vessel_masked == "True"},
+            )
+            row[Overlay] = file[key]
+
+    wide = _depth_table(list(rows.values())).sort_index()
+    if sources is not None:
+        wide.attrs["sources"] = sources
     return wide
 
 
+@timed()
+def load_depth_data(datpath: str, workers: int = None):
+    """
+    Loads data as a function of cortical depth. The table is cached in
+    depth_data.npz together with a manifest of the JSON files it was built
+    from, so only new or changed subjects are parsed again, in parallel by
+    up to workers processes. Without any subject folders the cache is used
+    as is, converting a legacy depth_data.pkl if needed.
+    """
+    fname = datpath + "/depth_data.npz"
+    folders = {
+        os.path.basename(folder.rstrip("/")): folder
+        for folder in subject_folders(datpath)
+    }
+    if not folders:
+        if os.path.isfile(fname):
+            return _read_depth_cache(fname)
+        if os.path.isfile(datpath + "/depth_data.pkl"):
+            wide = pd.read_pickle(datpath + "/depth_data.pkl")
+            _write_depth_cache(fname, wide)
+            return wide
+
+    # processes starting on a stale cache wait for the first one to rebuild
+    # it and then find it up to date
+    with _file_lock(fname + ".lock"):
+        if os.path.isfile(fname):
+            wide = _read_depth_cache(fname)
+        elif os.path.isfile(datpath + "/depth_data.pkl"):
+            wide = pd.read_pickle(datpath + "/depth_data.pkl")
+        else:
+            wide = None
+
+        cached_sources = {}
+        if wide is not None:
+            # a cache without manifest cannot be checked, all subjects are stale
+            cached_sources = wide.attrs.get(
+                "sources", dict.fromkeys(wide.index.get_level_values(0))
+            )
+        sources, changed, removed = _stale_subjects(folders, cached_sources, ".json")
+        if wide is not None and not changed and not removed:
+            return wide
+
+        df_list = []
+        for subject_list in _parse_subjects(_parse_depth_subject, folders, changed, workers):
+            df_list.extend(subject_list)
+        wide_new = _depth_table(df_list)
+        if wide is not None:
+            keep = ~wide.index.get_level_values(0).isin(changed + removed)
+            wide_new = pd.concat([wide[keep], wide_new])
+        wide = wide_new.sort_index()
+        wide.attrs["sources"] = sources
+
+        _write_depth_cache(fname, wide)
+    return wide
+
+
+class SurfaceDataset:
+    """
+    Lazy access to the surface store. Subjects are listed from the store
+    index, which is brought up to date on first data access. A subject's
+    arrays are opened on first access and kept in a least recently used
+    cache bounded to max_bytes.
+    """
+
+    def __init__(self, datpath: str, max_bytes: int = SURFACE_CACHE_BYTES, workers: int = None):
+        self.datpath = datpath
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._store = None
+        self._entries = None
+        self._cache = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.RLock()
+
+    def _index(self):
+        with self._lock:
+            if self._entries is None:
+                self._store = update_surface_store(self.datpath, self.workers)
+                index = _read_surface_index(self._store) or {"entries": []}
+                entries = {}
+                for entry in index["entries"]:
+                    entries.setdefault(entry["Subject"], []).append(entry)
+                self._entries = entries
+            return self._entries
+
+    @property
+    def subjects(self):
+        """
+        Subjects listed in the store index. The sources are only checked and
+        the store updated on first data access, unless there is no store yet
+        """
+        with self._lock:
+            if self._entries is not None:
+                return sorted(self._entries)
+        index = _read_surface_index(os.path.join(self.datpath, "surface_store"))
+        if index is None:
+            return sorted(self._index())
+        return sorted({entry["Subject"] for entry in index["entries"]})
+
+    def layers(self, subject: str):
+        return sorted({entry["Layer"] for entry in self._index()[subject]})
+
+    def overlays(self, subject: str, Layer: str):
+        """
+        Overlays of a subject's layer, without the surfaces themselves
+        """
+        return sorted(
+            entry["Overlay"] for entry in self._index()[subject]
+            if entry["Layer"] == Layer and entry["Overlay"] not in ["native", "unfolded"]
+        )
+
+    def _open_subject(self, subject: str):
+        return {
+            (entry["Layer"], entry["Overlay"]): _open_entry(self._store, entry)
+            for entry in self._index()[subject]
+        }
+
+    def subject_data(self, subject: str):
+        """
+        All arrays of a subject as dict of (Layer, Overlay) -> data
+        """
+        with self._lock:
+            if subject in self._cache:
+                self._cache.move_to_end(subject)
+                return self._cache[subject][0]
+
+            try:
+                data = self._open_subject(subject)
+            except FileNotFoundError:
+                # another process rebuilt the subject and deleted the arrays
+                # of the index read before
+                self._entries = None
+                data = self._open_subject(subject)
+            nbytes = sum(
+                dat.vertices.nbytes + dat.faces.nbytes if isinstance(dat, Mesh) else dat.nbytes
+                for dat in data.values()
+            )
+            self._cache[subject] = (data, nbytes)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_bytes and len(self._cache) > 1:
+                _, (_, evicted) = self._cache.popitem(last=False)
+                self._nbytes -= evicted
+            return data
+
+    def get(self, subject: str, Layer: str, Overlay: str):
+        return self.subject_data(subject)[(Layer, Overlay)]
+
+
+class DepthDataset:
+    """
+    Lazy access to the depth profiles, loaded on first access
+    """
+
+    def __init__(self, datpath: str, workers: int = None):
+        self.datpath = datpath
+        self.workers = workers
+        self._wide = None
+        self._cubes = {}
+        self._lock = threading.Lock()
+
+    def table(self):
+        with self._lock:
+            if self._wide is None:
+                self._wide = load_depth_data(self.datpath, self.workers)
+            return self._wide
+
+    @property
+    def subjects(self):
+        """
+        Subjects in depth_data.npz, read from the names of its arrays without
+        loading them. The sources are only checked on first data access,
+        unless there is no cache yet
+        """
+        fname = self.datpath + "/depth_data.npz"
+        with self._lock:
+            wide = self._wide
+        if wide is None and os.path.isfile(fname):
+            with np.load(fname) as file:
+                return sorted({key.split("/")[0] for key in file.files if key != "sources"})
+        return sorted(set(self.table().index.get_level_values(0)))
+
+    def cube(self, contrast: str, vessel_masked: bool, Overlay: str):
+        """
+        All subjects' profiles of one contrast and overlay stacked into a
+        dense subject x depth x subfield array, built once, and a dict of
+        subject -> index into its first axis. Cells without data are NaN.
+        """
+        key = (contrast, vessel_masked, Overlay)
+        wide = self.table()
+        with self._lock:
+            if key not in self._cubes:
+                cells = wide.xs(
+                    (contrast, vessel_masked), level=("contrast", "vessel_masked")
+                )[Overlay]
+                shape = next(
+                    dat.shape for dat in cells if isinstance(dat, np.ndarray)
+                )
+                cube = np.full((len(cells),) + shape, np.nan)
+                for idx, dat in enumerate(cells):
+                    if isinstance(dat, np.ndarray):
+                        cube[idx] = dat
+                index = {subject: idx for idx, subject in enumerate(cells.index)}
+                self._cubes[key] = (cube, index)
+            return self._cubes[key]
+
+    def select(self, subjects, contrast: str, vessel_masked: bool, Overlay: str):
+        """
+        Profiles of the given subjects as depth x subfield x subject array,
+        gathered from the cube with a single fancy index
+        """
+        cube, index = self.cube(contrast, vessel_masked, Overlay)
+        return np.moveaxis(cube[[index[s] for s in subjects]], 0, -1)
+
+
 datpath = os.path.dirname(__file__)
-surface_data = load_surface_data(datpath=datpath)
-depth_data = load_depth_data(datpath=datpath)
+surface_data = SurfaceDataset(datpath=datpath)
+depth_data = DepthDataset(datpath=datpath)
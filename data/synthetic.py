@@ -0,0 +1,208 @@
+"""
+Writes a synthetic cohort in the folder layout read by data_loader, to test
+how loading and plotting scale with the number of subjects and the mesh
+size without the real data.
+
+Run from the repository root:
+
+    python -m data.synthetic /tmp/synthetic --subjects 100 --vertices 20000
+
+Every subject gets tube-like inner/outer surfaces with five subfield label
+bands, all surface overlays and the breath-hold and memory depth profiles.
+Subjects are named 9000, 9001, ... next to an avg subject. The loaders and
+the app read the cohort with e.g. SurfaceDataset(datpath="/tmp/synthetic").
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+import nibabel as nib
+
+
+BH_OVERLAYS = ["T2s", "angio", "dSbreathhold", "dSbreathhold_weighted"]
+MEM_OVERLAYS = ["tSNR", "tSNR_vessel_masked"]
+N_DEPTH = 30
+N_SUBFIELDS = 5
+
+
+def tube_mesh(n_vertices: int):
+    """
+    Closed tube of about n_vertices vertices, twice as long as round, with
+    five label bands along its length
+    """
+    nu = max(int(np.sqrt(n_vertices / 2)), 3)
+    nv = max(n_vertices // nu, 2)
+    theta = np.linspace(0, 2*np.pi, nu, endpoint=False)
+    z = np.linspace(0, 10, nv)
+    T, Z = np.meshgrid(theta, z, indexing="ij")
+    vertices = np.stack([
+        np.cos(T).ravel()*(2+0.3*np.sin(Z.ravel())),
+        np.sin(T).ravel()*2,
+        Z.ravel()
+    ], axis=1).astype(np.float32)
+
+    idx = np.arange(nu*nv).reshape(nu, nv)
+    nxt = np.roll(idx, -1, axis=0)
+    faces = np.concatenate([
+        np.stack([idx[:, :-1], nxt[:, :-1], idx[:, 1:]], axis=-1).reshape(-1, 3),
+        np.stack([nxt[:, :-1], nxt[:, 1:], idx[:, 1:]], axis=-1).reshape(-1, 3),
+    ]).astype(np.int32)
+    labels = (np.floor(Z.ravel()/10*4.999)+1).astype(np.int32)
+    return vertices, faces, labels
+
+
+def _save_surf(fname: str, vertices, faces):
+    nib.save(nib.gifti.GiftiImage(darrays=[
+        nib.gifti.GiftiDataArray(
+            vertices.astype(np.float32),
+            intent="NIFTI_INTENT_POINTSET",
+            datatype="NIFTI_TYPE_FLOAT32",
+        ),
+        nib.gifti.GiftiDataArray(
+            faces.astype(np.int32),
+            intent="NIFTI_INTENT_TRIANGLE",
+            datatype="NIFTI_TYPE_INT32",
+        ),
+    ]), fname)
+
+
+def _save_shape(fname: str, dat, datatype: str = "NIFTI_TYPE_FLOAT32"):
+    nib.save(nib.gifti.GiftiImage(darrays=[
+        nib.gifti.GiftiDataArray(dat, datatype=datatype)
+    ]), fname)
+
+
+def _save_json(fname: str, dat: dict):
+    with open(fname, "w") as file:
+        json.dump({key: val.tolist() for key, val in dat.items()}, file)
+
+
+def write_subject(folder: str, subject: str, vertices, faces, labels, rng):
+    """
+    Writes all files of one subject into folder/subject
+    """
+    base = os.path.join(folder, subject)
+    is_avg = subject == "avg"
+    prefix = f"sub-{subject}_hemi-L"
+
+    bh_dir = os.path.join(base, "breathhold")
+    mem_dir = os.path.join(base, "memory") if is_avg else \
+              os.path.join(base, "memory", "native")
+    depth_dir = os.path.join(base, "memory") if is_avg else \
+                os.path.join(base, "memory", "z_transformed")
+    surf_dir = os.path.join(base, "hippunfold") if is_avg else \
+               os.path.join(base, "hippunfold", "surf")
+    for path in [bh_dir, mem_dir, depth_dir, surf_dir]:
+        os.makedirs(path, exist_ok=True)
+
+    n_vertices = len(vertices)
+    for Layer, scale in [("inner", 1), ("outer", 1.1)]:
+        # overlays
+        for Overlay in BH_OVERLAYS:
+            _save_shape(
+                os.path.join(bh_dir, f"{prefix}_{Layer}_{Overlay}.shape.gii"),
+                rng.normal(20, 10, n_vertices).astype(np.float32),
+            )
+        for Overlay in MEM_OVERLAYS:
+            _save_shape(
+                os.path.join(mem_dir, f"{prefix}_{Layer}_{Overlay}.shape.gii"),
+                rng.normal(40, 5, n_vertices).astype(np.float32),
+            )
+
+        # surfaces, avg also has the unfolded surface
+        if is_avg:
+            _save_surf(
+                os.path.join(surf_dir, f"tpl-avg_hemi-L_{Layer}.native.surf.gii"),
+                vertices*scale, faces,
+            )
+            unfolded = np.stack([
+                vertices[:, 2],
+                np.arctan2(vertices[:, 1], vertices[:, 0]),
+                np.zeros(n_vertices),
+            ], axis=1)
+            _save_surf(
+                os.path.join(surf_dir, f"tpl-avg_hemi-L_{Layer}.unfolded.surf.gii"),
+                unfolded, faces,
+            )
+        else:
+            _save_surf(
+                os.path.join(
+                    surf_dir, f"{prefix}_space-T2w_den-0p5mm_label-hipp_{Layer}.surf.gii"
+                ),
+                vertices*scale, faces,
+            )
+
+    label_file = "tpl-avg_hemi-L_atlas-bigbrain_subfields.label.gii" if is_avg else \
+                 f"{prefix}_space-T2w_den-0p5mm_label-hipp_atlas-bigbrain_subfields.label.gii"
+    _save_shape(
+        os.path.join(surf_dir, label_file), labels.astype(np.int32), "NIFTI_TYPE_INT32"
+    )
+
+    # depth profiles, breath-hold as depth x subfield (R2* of single
+    # subjects with a trailing dimension), memory as subfield x depth
+    shape = (N_DEPTH, N_SUBFIELDS)
+    if is_avg:
+        bh = {
+            "T2s_submean": rng.normal(30, 5, shape),
+            "dS_mean_echo_submean": rng.normal(5, 3, shape),
+            "dS_mean_echo_weighted_submean": rng.normal(1, 0.5, shape),
+        }
+        contrasts = ["memory_vs_math", "pre_vs_post"]
+    else:
+        bh = {
+            "R2s": rng.uniform(0.02, 0.05, shape + (1,)),
+            "dS_mean_echo": rng.normal(5, 3, shape),
+            "dS_mean_echo_weighted": rng.normal(1, 0.5, shape),
+        }
+        # memory_vs_rest is not read by the loader
+        contrasts = ["memory_vs_math", "memory_vs_rest", "pre_vs_post"]
+    _save_json(os.path.join(bh_dir, f"{prefix}_depth.json"), bh)
+
+    for contrast in contrasts:
+        for suffix in ["", "_vessel_masked"]:
+            _save_json(
+                os.path.join(depth_dir, f"{prefix}_{contrast}{suffix}.json"),
+                {
+                    "con_array": rng.normal(0.5, 1, shape[::-1]),
+                    "tSNR": rng.normal(40, 5, shape[::-1]),
+                },
+            )
+
+
+def write_cohort(folder: str, n_subjects: int, n_vertices: int = 10000, seed: int = 0):
+    """
+    Writes n_subjects synthetic subjects and avg into folder. Returns the
+    subject names
+    """
+    rng = np.random.default_rng(seed)
+    vertices, faces, labels = tube_mesh(n_vertices)
+    subjects = [str(9000+idx) for idx in range(n_subjects)] + ["avg"]
+    for subject in subjects:
+        write_subject(folder, subject, vertices, faces, labels, rng)
+    return subjects
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("out", help="folder to write the cohort to")
+    parser.add_argument(
+        "--subjects", type=int, default=10, help="number of subjects besides avg"
+    )
+    parser.add_argument(
+        "--vertices", type=int, default=10000, help="approximate vertices per surface"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    subjects = write_cohort(args.out, args.subjects, args.vertices, args.seed)
+    print(
+        f"wrote {len(subjects)} subjects to {args.out} "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
-import os
-import numpy as np
 from shiny import ui, module, reactive, render
 from shinywidgets import (
     output_widget,
     render_widget
 )
-from utils.plot_helper import create_line_plot
+import plotly.graph_objects as go
+from utils.plot_helper import create_line_spec, build_off_loop
+from utils.export_helper import (
+    export_depth_csv, export_depth_npz, depth_export_filename
+)
+from utils.metrics_helper import stage
 from utils.text_helper import (
     about_line_text
 )
@@ -14,7 +17,7 @@ import unicodeit
 
 from data.data_loader import depth_data
 
-all_subjects    = list(np.unique(depth_data.index.get_level_values(0)))
+all_subjects    = depth_data.subjects
 subject_choices = all_subjects
 overlay_choices = [
     "T2*","hyperemia \u0394S","weighted hyperemia \u0394S",
@@ -27,6 +30,8 @@ Overlay_to_show = {"T2*":"T2s",unicodeit.replace("\\beta"):"beta","tSNR":"tSNR",
                   "hyperemia \u0394S":"dSbreathhold","weighted hyperemia \u0394S":"dSbreathhold_weighted",
                   }
 
+band_choices = {"None":None, "Mean \u00b1 SEM":"sem", "Mean, 95% bootstrap CI":"ci"}
+
 contrast_to_show = {"breath-hold":"breathhold","memory vs. math":"memory_vs_math","construction vs. elaboration":"pre_vs_post"}
 
 @module.ui
@@ -76,11 +81,25 @@ def depth_ui():
                         )
                 )
             ),
+            ui.input_selectize(
+                id="band_select",
+                label="Group band of selected subjects",
+                choices=list(band_choices),
+                selected="None",
+                multiple=False
+            ),
             ui.row(
                 ui.tags.hr(),
+                ui.input_radio_buttons(
+                    id="export_format",
+                    label="Export format",
+                    choices={"csv":"CSV","npz":"NPZ"},
+                    selected="csv",
+                    inline=True
+                ),
                 ui.download_button(
                     "download_depth_data",
-                    label="Download data",
+                    label="Download selection",
                     class_="btn-primary"
                 ),
             ),
@@ -97,7 +116,7 @@ def depth_server(input, output, session):
 
     @reactive.effect
     def remove_missing_subject():
-        all_subjects = list(np.unique(depth_data.index.get_level_values(0)))
+        all_subjects = depth_data.subjects
         if input.contrast_select() == "breath-hold":
             all_subjects = [s for s in all_subjects if s != "7491"]
         else:
@@ -106,7 +125,7 @@ def depth_server(input, output, session):
         
     @reactive.effect
     def load_all():
-        all_subjects = list(np.unique(depth_data.index.get_level_values(0))) 
+        all_subjects = depth_data.subjects
         if input.contrast_select() == "breath-hold":
             all_subjects = [s for s in all_subjects if s != "7491"]
         else:
@@ -126,15 +145,30 @@ def depth_server(input, output, session):
         
         ui.update_selectize("overlay_select",choices=inp,selected=inp[0])
     
-    @reactive.Calc
-    def line_fig():
-        return create_line_plot(
-            depth_data=depth_data,
-            subject=input.subject_multiselect(),
+    @reactive.extended_task
+    async def line_task(params: dict):
+        #built in a worker thread, the event loop stays free meanwhile
+        return await build_off_loop(create_line_spec, depth_data=depth_data, **params)
+
+    @reactive.effect
+    def start_line_build():
+        params = dict(
+            subject=list(input.subject_multiselect()),
             Overlay=Overlay_to_show[input.overlay_select()],
             contrast=contrast_to_show[input.contrast_select()],
-            vessel_masked=input.vessel_masked()
-        ) 
+            vessel_masked=input.vessel_masked(),
+            consolidated=input.show_all(),
+            band=band_choices[input.band_select()],
+        )
+        #a build still running for previous inputs is superseded
+        line_task.cancel()
+        line_task.invoke(params)
+
+    @reactive.Calc
+    def line_fig():
+        spec = line_task.result()
+        with stage("line_fig"):
+            return go.FigureWidget(spec)
     
 
     @output(suspend_when_hidden=True)
@@ -142,7 +176,27 @@ def depth_server(input, output, session):
     def line_plot():
         return line_fig()
     
-    @render.download()
+    def export_selection():
+        #the current selection as shown in the plot
+        contrast = contrast_to_show[input.contrast_select()]
+        vessel_masked = False if contrast == "breathhold" else input.vessel_masked()
+        return dict(
+            subjects=list(input.subject_multiselect()),
+            contrast=contrast,
+            vessel_masked=vessel_masked,
+            Overlay=Overlay_to_show[input.overlay_select()],
+        )
+
+    def export_filename():
+        selection = export_selection()
+        return depth_export_filename(
+            contrast=selection["contrast"],
+            Overlay=selection["Overlay"],
+            vessel_masked=selection["vessel_masked"],
+            fmt=input.export_format(),
+        )
+
+    @render.download(filename=export_filename, media_type="application/octet-stream")
     def download_depth_data():
-        path = os.path.join(os.path.dirname(__file__), "../data/depth_data.pkl")
-        return path
\ No newline at end of file
+        export = export_depth_csv if input.export_format() == "csv" else export_depth_npz
+        yield from export(depth_data, **export_selection())
\ No newline at end of file
@@ -3,17 +3,23 @@ from shinywidgets import (
     output_widget,
     render_widget
 )
-from utils.plot_helper import create_surface_plot,create_colormaps,create_overlay_file
+import plotly.graph_objects as go
+from utils.plot_helper import (
+    load_surface_spec, build_off_loop, create_colormaps, create_overlay_file, overlay_filename,
+    surface_border_traces, surface_overlay_properties, surface_lod_level
+)
+from utils.export_helper import export_overlay_zip
+from utils.metrics_helper import stage, count
+from utils.reactive_helper import debounce
 from utils.text_helper import (
     about_text, extra_notes
 )
 
 import unicodeit
-import numpy as np
 
 from data.data_loader import surface_data
 
-subject_choices = list(np.unique(surface_data.index.get_level_values(0))) #["7218", "7495"] + ['avg']
+subject_choices = surface_data.subjects #["7218", "7495"] + ['avg']
 overlay_choices = [
     "T2*","angio","hyperemia \u0394S","weighted hyperemia \u0394S",
     "tSNR","vessel masked tSNR"
@@ -26,6 +32,9 @@ Overlay_to_show = {"Subfields":"Subfields","angio":"angio","T2*":"T2s",
 
 colormaps = create_colormaps()
 
+#seconds the color range slider has to rest before the figure is patched
+SLIDER_DEBOUNCE = 0.3
+
 @module.ui
 def surface_ui():
     surface_gui = ui.layout_sidebar(
@@ -75,6 +84,11 @@ def surface_ui():
                         )
                 )
             ),
+            ui.input_checkbox(
+                id="full_detail_select",
+                label="Full detail",
+                value=False
+            ),
             ui.tags.hr(),
             extra_notes,
             ui.tags.hr(),
@@ -83,6 +97,11 @@ def surface_ui():
                 "download_surface_data",
                 label="Download map",
                 class_="btn-danger"
+            ),
+            ui.download_button(
+                "download_surface_zip",
+                label="Download all maps",
+                class_="btn-danger"
             ),            
             class_="card text-white bg-danger mb-3"
         ),
@@ -95,53 +114,240 @@ def surface_ui():
 @module.server
 def surface_server(input, output, session):    
 
+    #dragging the slider only patches the figure once it rests
+    colorrange = debounce(input.colorrange, SLIDER_DEBOUNCE)
+
+    #subject choices currently offered to the client
+    shown_subjects = surface_data.subjects
+    #values pushed to the inputs by sync_sidebar. The client sends them back
+    #as input changes, which are echoes and no user actions
+    pushed = {}
+
     @reactive.effect
-    def remove_missing_subject():
-        all_subjects = list(np.unique(surface_data.index.get_level_values(0)))
+    @reactive.event(input.overlay_select)
+    def sync_sidebar():
+        nonlocal shown_subjects
+        #all updates an overlay switch causes, batched into one effect: the 
+        #subject choices, the slider and the overlay patch of the shown figure
+        Overlay = Overlay_to_show[input.overlay_select()]
+        all_subjects = surface_data.subjects
         if input.overlay_select() not in ["tSNR","vessel masked tSNR"]:
             all_subjects = [s for s in all_subjects if s != "7491"]
-        else:
-            all_subjects
-        
-        selected = "avg" if input.subject_select() == "7491" else input.subject_select()
-        ui.update_selectize("subject_select",choices=all_subjects,selected=selected)
 
-    @reactive.effect
-    def _():
-        mymin = colormaps[Overlay_to_show[input.overlay_select()]][2]-10
-        mymax = colormaps[Overlay_to_show[input.overlay_select()]][3]+10
+        subject = input.subject_select()
+        selected = "avg" if subject not in all_subjects else subject
+        if all_subjects != shown_subjects:
+            ui.update_selectize("subject_select",choices=all_subjects,selected=selected)
+            shown_subjects = all_subjects
+        if selected != subject:
+            pushed["subject"] = selected
+
+        mymin = colormaps[Overlay][2]-10
+        mymax = colormaps[Overlay][3]+10
         myvalue = [mymin+10, mymax-10]
         ui.update_slider("colorrange",
                          min=mymin,
                          max=mymax,
                          value=myvalue
                          )
+        pushed["colorrange"] = tuple(myvalue)
+
+        #a replaced subject is rebuilt with the new overlay anyway
+        widget, params = displayed_widget()
+        if widget is not None and selected == subject:
+            patch_overlay(widget, params)
+            count("surface", "patch")
+
+    #input values of the last counted flush
+    seen = {}
+
+    @reactive.effect
+    def count_user_action():
+        #one action per flush with changed inputs, not counting echoes
+        current = dict(
+            subject=input.subject_select(),
+            Layer=input.layer_select(),
+            Overlay=input.overlay_select(),
+            colorrange=tuple(colorrange()),
+            unfolded=input.unfolded_select(),
+            borders=input.borders_select(),
+            full_detail=input.full_detail_select(),
+        )
+        changed = [key for key, val in current.items() if seen.get(key) != val]
+        echoes = [key for key in changed if pushed.pop(key, None) == current[key]]
+        seen.update(current)
+        if len(changed) > len(echoes):
+            count("surface", "action")
     
-    @reactive.Calc
-    def surface_fig():        
-        return create_surface_plot(
+    @reactive.extended_task
+    async def surface_task(params: dict):
+        #the level of detail and the spec are resolved in worker threads, 
+        #the event loop stays free for other sessions meanwhile. This 
+        #includes the first data access, which may update the surface store
+        lod = 0
+        if not params["full_detail"]:
+            #decimated mesh unless full detail is requested
+            lod = await build_off_loop(
+                surface_lod_level,
+                surface_data=surface_data,
+                subject=params["subject"],
+                Layer=params["Layer"],
+                unfolded=params["unfolded"],
+            )
+        spec = await build_off_loop(
+            load_surface_spec,
             surface_data=surface_data,
+            subject=params["subject"],
+            Overlay=params["Overlay"],
+            Layer=params["Layer"],
+            unfolded=params["unfolded"],
+            show_borders=params["show_borders"],
+            colorrange=params["colorrange"],
+            lod=lod,
+        )
+        return spec, dict(params, lod=lod)
+
+    @reactive.effect
+    def start_surface_build():
+        #overlay, color range and borders are patched into the existing 
+        #widget below, so changing them must not rebuild the figure
+        with reactive.isolate():
+            colorrange_value = tuple(colorrange())
+            Overlay = Overlay_to_show[input.overlay_select()]
+            show_borders = input.borders_select()
+        params = dict(
             subject=input.subject_select(),
-            Overlay=Overlay_to_show[input.overlay_select()],
+            Overlay=Overlay,
             Layer=input.layer_select(),
             unfolded=input.unfolded_select(),
-            show_borders=input.borders_select(),
-            colorrange=input.colorrange(),
-        ) 
+            show_borders=show_borders,
+            colorrange=colorrange_value,
+            full_detail=input.full_detail_select(),
+        )
+        count("surface", "build")
+        #a build still running for previous inputs is superseded
+        surface_task.cancel()
+        surface_task.invoke(params)
+
+    @reactive.Calc
+    def surface_fig():
+        spec, params = surface_task.result()
+        with stage("surface_fig"):
+            widget = go.FigureWidget(spec)
+        
+        #inputs patched while the figure was being built
+        with reactive.isolate():
+            if Overlay_to_show[input.overlay_select()] != params["Overlay"]:
+                patch_overlay(widget, params)
+            if tuple(colorrange()) != params["colorrange"]:
+                patch_colorrange(widget)
+            if input.borders_select() != params["show_borders"]:
+                patch_borders(widget, params)
+        return widget, params
+
+    #widget on screen and the params it was built from
+    shown = {}
 
     @output(suspend_when_hidden=True)
     @render_widget
     def surface_plot():
-        return surface_fig()
-    
+        widget, params = surface_fig()
+        shown.update(widget=widget, params=params)
+        return widget
+
+    def displayed_widget():
+        #the widget on screen and its params, if it shows the mesh the inputs
+        #ask for. Otherwise (None, None): before the first build and while a
+        #rebuild runs, whose widget surface_fig patches once it is done
+        if surface_task.status() != "success" or not shown:
+            return None, None
+        params = shown["params"]
+        current = dict(
+            subject=input.subject_select(),
+            Layer=input.layer_select(),
+            unfolded=input.unfolded_select(),
+            full_detail=input.full_detail_select(),
+        )
+        if any(params[key] != val for key, val in current.items()):
+            return None, None
+        return shown["widget"], params
     
+    def patch_overlay(widget, params):
+        #only intensity, colorscale and hover template change, the mesh stays
+        #on the client. The color range is reset to the overlay default, as
+        #is the slider. Values are resampled to the mesh of the widget
+        widget.data[0].update(
+            surface_overlay_properties(
+                surface_data=surface_data,
+                subject=params["subject"],
+                Overlay=Overlay_to_show[input.overlay_select()],
+                Layer=params["Layer"],
+                unfolded=params["unfolded"],
+                lod=params["lod"],
+            )
+        )
+
+    def patch_colorrange(widget)->bool:
+        #the slider reset of an overlay switch comes back as a color range
+        #the overlay patch already set
+        cmin, cmax = colorrange()
+        if (widget.data[0].cmin, widget.data[0].cmax) == (cmin, cmax):
+            return False
+        widget.data[0].update(cmin=cmin, cmax=cmax)
+        return True
+
+    def patch_borders(widget, params):
+        if not input.borders_select():
+            widget.data = widget.data[:1]
+        elif len(widget.data) == 1:
+            widget.add_traces(
+                surface_border_traces(
+                    surface_data=surface_data,
+                    subject=params["subject"],
+                    Layer=params["Layer"],
+                    unfolded=params["unfolded"],
+                    lod=params["lod"],
+                )
+            )
+
+    @reactive.effect
+    @reactive.event(colorrange)
+    def update_colorrange():
+        widget, _ = displayed_widget()
+        if widget is not None and patch_colorrange(widget):
+            count("surface", "patch")
+
+    @reactive.effect
+    @reactive.event(input.borders_select)
+    def update_borders():
+        widget, params = displayed_widget()
+        if widget is not None:
+            patch_borders(widget, params)
+            count("surface", "patch")
 
-    @render.download()
+    @render.download(
+        filename=lambda: overlay_filename(
+            subject=input.subject_select(),
+            Layer=input.layer_select(),
+            Overlay=Overlay_to_show[input.overlay_select()]
+        ),
+        media_type="application/octet-stream",
+    )
     def download_surface_data():
-        return create_overlay_file(
+        yield create_overlay_file(
             data=surface_data,
             subject=input.subject_select(),
             Layer=input.layer_select(),
             Overlay=Overlay_to_show[input.overlay_select()]
         )    
 
+    @render.download(
+        filename=lambda: f"sub-{input.subject_select()}_{input.layer_select()}.zip",
+        media_type="application/zip",
+    )
+    def download_surface_zip():
+        yield from export_overlay_zip(
+            surface_data=surface_data,
+            subject=input.subject_select(),
+            Layer=input.layer_select(),
+        )
@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+
+from utils.metrics_helper import timed, register_cache
+from utils.utils import (
+    create_border_coordinates, subfield_names, decimate_mesh, 
+    resample_labels, mean_edge_length
+)
+
+"""
+Python file for caches of derived surface data that outlive a single
+session and are shared between worker processes via the file system
+"""
+
+#bump when the layout or content of derived assets changes
+ASSET_VERSION = 1
+artifact_dir = os.path.join(
+    os.path.dirname(__file__), f"../data/artifacts/v{ASSET_VERSION}"
+)
+
+#assets already read or computed by this process
+_ASSET_CACHE_SIZE = 64
+_assets = OrderedDict()
+#hits are assets found in memory or on disk, misses had to be computed
+asset_cache_stats = {"hits": 0, "misses": 0}
+_assets_lock = threading.Lock()
+
+#figure specs and encoded downloads shared by all sessions of this process
+_FIGURE_CACHE_SIZE = 32
+_figures = OrderedDict()
+figure_cache_stats = {"hits": 0, "misses": 0}
+_OVERLAY_FILE_CACHE_SIZE = 64
+_overlay_files = OrderedDict()
+overlay_file_cache_stats = {"hits": 0, "misses": 0}
+_shared_lock = threading.Lock()
+
+#mkstemp creates files readable by their owner only, written files get the
+#permissions of a regular file instead, so other users can read them
+_umask = os.umask(0)
+os.umask(_umask)
+
+
+def content_hash(*arrays):
+    """
+    Hash over dtype, shape and content of the given arrays
+    """
+    h = hashlib.sha1()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(str(arr.dtype).encode())
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def save_npz(fname: str, arrays: dict):
+    """
+    Writes arrays to an .npz file. The file is written under a temporary
+    name and moved in place, so concurrent readers never see partial files
+    """
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            np.savez(file, **arrays)
+        os.chmod(tmp, 0o644 & ~_umask)
+        os.replace(tmp, fname)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def load_asset(kind: str, arrays: tuple, compute):
+    """
+    Returns the dict of arrays derived from arrays by compute. Results are
+    looked up in memory, then in the artifact directory and only computed
+    (and written to the artifact directory, if it is writable) if neither
+    holds them.
+    """
+    key = (kind, content_hash(*arrays))
+    with _assets_lock:
+        if key in _assets:
+            _assets.move_to_end(key)
+            asset_cache_stats["hits"] += 1
+            return _assets[key]
+
+    fname = os.path.join(artifact_dir, kind, key[1] + ".npz")
+    if os.path.isfile(fname):
+        with np.load(fname) as file:
+            asset = {name: file[name] for name in file.files}
+        found = True
+    else:
+        asset = compute()
+        try:
+            save_npz(fname, asset)
+        except OSError:
+            # e.g. a read-only artifact directory, the asset is only kept
+            # in memory then
+            pass
+        found = False
+
+    with _assets_lock:
+        asset_cache_stats["hits" if found else "misses"] += 1
+        _assets[key] = asset
+        if len(_assets) > _ASSET_CACHE_SIZE:
+            _assets.popitem(last=False)
+    return asset
+
+
+def load_border_coordinates(faces, vertices, labels):
+    """
+    Border coordinates of labels on the mesh given by faces and vertices
+    """
+    return load_asset(
+        "borders",
+        (faces, vertices, labels),
+        lambda: create_border_coordinates(faces, vertices, labels),
+    )
+
+
+@timed()
+def load_subfield_names(labels):
+    """
+    Subfield name of every vertex, used as hover data
+    """
+    return load_asset(
+        "hover",
+        (labels,),
+        lambda: {"subfield": subfield_names(labels)},
+    )["subfield"]
+
+
+def load_mesh_lod(faces, vertices, labels, level: int):
+    """
+    Decimated version of a mesh at detail level (0 is the full mesh). Each
+    level doubles the clustering cell size, starting at the mean edge length,
+    which leaves about a quarter of the vertices of the previous level.
+    Besides vertices, faces and labels, the asset holds the cluster index
+    of every full resolution vertex, used to resample overlays.
+    """
+    def compute():
+        cell_size = mean_edge_length(vertices, faces) * 2**level
+        new_vertices, new_faces, cluster = decimate_mesh(vertices, faces, cell_size)
+        return {
+            "vertices": new_vertices,
+            "faces": new_faces,
+            "labels": resample_labels(cluster, labels),
+            "cluster": cluster,
+        }
+    return load_asset(f"lod{level}", (faces, vertices, labels), compute)
+
+
+def load_colorscales(compute):
+    """
+    Colorscales per overlay as written by the asset build, computed if the
+    build has not been run
+    """
+    fname = os.path.join(artifact_dir, "colorscales.json")
+    if os.path.isfile(fname):
+        with open(fname) as file:
+            return json.load(file)
+    return compute()
+
+
+def _load_shared(cache: OrderedDict, size: int, stats: dict, key: tuple, compute):
+    """
+    LRU lookup in one of the caches shared between sessions. compute runs
+    outside the lock, so concurrent misses of the same key may both compute
+    """
+    with _shared_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            stats["hits"] += 1
+            return cache[key]
+        stats["misses"] += 1
+
+    value = compute()
+
+    with _shared_lock:
+        cache[key] = value
+        if len(cache) > size:
+            cache.popitem(last=False)
+    return value
+
+
+def load_figure(key: tuple, compute):
+    """
+    Figure spec (as returned by Figure.to_dict()) for key, built by compute
+    on a miss. The spec is shared between callers and must not be modified,
+    create a widget or figure from it instead.
+    """
+    return _load_shared(_figures, _FIGURE_CACHE_SIZE, figure_cache_stats, key, compute)
+
+
+def load_overlay_file(key: tuple, compute) -> bytes:
+    """
+    Encoded overlay file for key, encoded by compute on a miss
+    """
+    return _load_shared(
+        _overlay_files, _OVERLAY_FILE_CACHE_SIZE, overlay_file_cache_stats, key, compute
+    )
+
+
+register_cache("assets", lambda: asset_cache_stats)
+register_cache("figures", lambda: figure_cache_stats)
+register_cache("overlay_files", lambda: overlay_file_cache_stats)
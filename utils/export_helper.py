@@ -0,0 +1,98 @@
+import io
+import zipfile
+import numpy as np
+
+from utils.plot_helper import _encode_overlay_file, overlay_filename
+
+"""
+Python file for the data exports. Exports are generators of byte chunks
+that render.download streams to the client, so large exports are never
+held in memory as a whole
+"""
+
+depth_subfields = ["Subiculum", "CA1", "CA2", "CA3", "CA4/DG"]
+
+
+class _ChunkWriter(io.RawIOBase):
+    """
+    Unseekable file object collecting everything written to it until the
+    chunks are taken with pop(). zipfile writes to unseekable files by
+    appending data descriptors instead of seeking back into the archive
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def pop(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def depth_export_filename(contrast: str, Overlay: str, vessel_masked: bool, fmt: str) -> str:
+    masked = "_vessel_masked" if vessel_masked else ""
+    return f"depth_{contrast}_{Overlay}{masked}.{fmt}"
+
+
+def export_depth_csv(depth_data, subjects, contrast: str, vessel_masked: bool, Overlay: str):
+    """
+    Depth profiles of the selected subjects as CSV in long format, one row
+    per subject, subfield and depth. Yields one chunk per subject
+    """
+    data = depth_data.select(subjects, contrast, vessel_masked, Overlay)
+    n_depth, n_subfields, _ = data.shape
+    subfield = np.repeat(depth_subfields[:n_subfields], n_depth)
+    depth = np.tile(np.arange(n_depth), n_subfields)
+
+    yield "subject,contrast,vessel_masked,overlay,subfield,depth,value\n".encode()
+    for idx, subject in enumerate(subjects):
+        # subfield-major, so rows of one subfield stay together
+        values = data[:, :, idx].T.ravel()
+        lines = [
+            f"{subject},{contrast},{vessel_masked},{Overlay},{s},{d},{v:.6g}\n"
+            for s, d, v in zip(subfield, depth, values)
+        ]
+        yield "".join(lines).encode()
+
+
+def export_depth_npz(depth_data, subjects, contrast: str, vessel_masked: bool, Overlay: str):
+    """
+    Depth profiles of the selected subjects as .npz with a subject x depth x
+    subfield array 'data' and the labels of its axes
+    """
+    data = depth_data.select(subjects, contrast, vessel_masked, Overlay)
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer,
+        data=np.moveaxis(data, -1, 0),
+        subjects=np.asarray(subjects, dtype=str),
+        subfields=np.asarray(depth_subfields[:data.shape[1]]),
+        contrast=np.asarray(contrast),
+        vessel_masked=np.asarray(vessel_masked),
+        overlay=np.asarray(Overlay),
+    )
+    yield buffer.getvalue()
+
+
+def export_overlay_zip(surface_data, subject: str, Layer: str):
+    """
+    ZIP of all overlays of a subject's layer as GIfTI. The archive is
+    written to an unseekable buffer and yielded file by file, so at most
+    one encoded overlay is held at a time. Members are encoded without the
+    shared overlay file cache, which one archive would otherwise fill
+    """
+    writer = _ChunkWriter()
+    # GIfTI data are compressed already
+    with zipfile.ZipFile(writer, mode="w", compression=zipfile.ZIP_STORED) as archive:
+        for Overlay in surface_data.overlays(subject, Layer):
+            data = _encode_overlay_file(surface_data, subject, Layer, Overlay)
+            archive.writestr(overlay_filename(subject, Layer, Overlay), data)
+            yield writer.pop()
+    yield writer.pop()
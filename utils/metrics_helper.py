@@ -0,0 +1,142 @@
+import functools
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+"""
+Python file for opt-in timing of the data loaders, figure builders and
+reactive calcs. Set HIPPOCAMPUS_VIEWER_METRICS=1 to record per-stage
+latency histograms, which app.py then serves in the Prometheus text format
+on /metrics. Without it, timed() leaves functions untouched and stage()
+does nothing.
+"""
+
+METRICS_ENABLED = os.environ.get("HIPPOCAMPUS_VIEWER_METRICS", "") == "1"
+
+#upper bounds of the latency histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_lock = threading.Lock()
+_histograms = defaultdict(lambda: {"buckets": [0]*len(BUCKETS), "sum": 0.0, "count": 0})
+#name -> function returning a dict with "hits" and "misses"
+_caches = {}
+#(view, event) -> count, events are "action", "build" and "patch"
+_events = defaultdict(int)
+
+
+def observe(name: str, seconds: float):
+    """
+    Adds one latency observation of stage name
+    """
+    with _lock:
+        histogram = _histograms[name]
+        for idx, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][idx] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Times the enclosed block as stage name
+    """
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def timed(name: str = None):
+    """
+    Decorator timing every call of a function as stage name, which defaults
+    to the function name
+    """
+    def decorator(func):
+        if not METRICS_ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def register_cache(name: str, stats):
+    """
+    Reports the hit/miss counters returned by stats() as cache name
+    """
+    _caches[name] = stats
+
+
+def count(view: str, event: str):
+    """
+    Counts one event of a view: a user action, or a figure build or patch
+    sent to the client in response
+    """
+    if not METRICS_ENABLED:
+        return
+    with _lock:
+        _events[(view, event)] += 1
+
+
+def render_metrics() -> str:
+    """
+    All histograms and cache counters in the Prometheus text format
+    """
+    lines = [
+        "# HELP hippocampus_viewer_stage_seconds Latency of loaders, figure builders and calcs",
+        "# TYPE hippocampus_viewer_stage_seconds histogram",
+    ]
+    with _lock:
+        histograms = {name: dict(val, buckets=list(val["buckets"]))
+                      for name, val in _histograms.items()}
+    for name, histogram in sorted(histograms.items()):
+        for bound, count in zip(BUCKETS, histogram["buckets"]):
+            lines.append(
+                f'hippocampus_viewer_stage_seconds_bucket{{stage="{name}",le="{bound}"}} {count}'
+            )
+        lines.append(
+            f'hippocampus_viewer_stage_seconds_bucket{{stage="{name}",le="+Inf"}} {histogram["count"]}'
+        )
+        lines.append(f'hippocampus_viewer_stage_seconds_sum{{stage="{name}"}} {histogram["sum"]}')
+        lines.append(f'hippocampus_viewer_stage_seconds_count{{stage="{name}"}} {histogram["count"]}')
+
+    caches = {name: stats() for name, stats in sorted(_caches.items())}
+    for metric in ["hits", "misses"]:
+        lines.append(f"# HELP hippocampus_viewer_cache_{metric}_total Cache {metric}")
+        lines.append(f"# TYPE hippocampus_viewer_cache_{metric}_total counter")
+        for name, stats in caches.items():
+            lines.append(
+                f'hippocampus_viewer_cache_{metric}_total{{cache="{name}"}} {stats[metric]}'
+            )
+    lines.append("# HELP hippocampus_viewer_cache_hit_ratio Share of cache lookups that were hits")
+    lines.append("# TYPE hippocampus_viewer_cache_hit_ratio gauge")
+    for name, stats in caches.items():
+        total = stats["hits"] + stats["misses"]
+        ratio = stats["hits"] / total if total else 0
+        lines.append(f'hippocampus_viewer_cache_hit_ratio{{cache="{name}"}} {ratio}')
+
+    with _lock:
+        events = dict(_events)
+    lines.append("# HELP hippocampus_viewer_events_total User actions and the figure builds and patches they caused")
+    lines.append("# TYPE hippocampus_viewer_events_total counter")
+    for (view, event), value in sorted(events.items()):
+        lines.append(f'hippocampus_viewer_events_total{{view="{view}",event="{event}"}} {value}')
+    lines.append("# HELP hippocampus_viewer_renders_per_action Figure builds and patches per user action")
+    lines.append("# TYPE hippocampus_viewer_renders_per_action gauge")
+    for view in sorted({view for view, _ in events}):
+        actions = events.get((view, "action"), 0)
+        renders = events.get((view, "build"), 0) + events.get((view, "patch"), 0)
+        ratio = renders / actions if actions else 0
+        lines.append(f'hippocampus_viewer_renders_per_action{{view="{view}"}} {ratio}')
+    return "\n".join(lines) + "\n"
@@ -6,9 +6,19 @@ import plotly.graph_objects as go # type: ignore
 import plotly.express as px
 import unicodeit
 import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 #from data.data_loader import load_surface_data,load_depth_data
-from utils.utils import create_border_coordinates
+from utils.utils import (
+    create_border_scatter, resample_vertex_data, typed_array, group_statistics
+)
+from utils.metrics_helper import timed, stage
+from utils.cache_helper import (
+    load_border_coordinates, load_subfield_names, load_colorscales, load_mesh_lod,
+    load_figure, load_overlay_file
+)
 
 """
 Python file to create function for plotting
@@ -50,14 +60,12 @@ def create_colormaps():
 
     return cdict
 
-def create_overlay_file(
-    data: dict,
-    subject: str,
-    Layer: str,
-    Overlay: str
-):
+def overlay_filename(subject: str, Layer: str, Overlay: str) -> str:
+    return f'sub-{subject}_{Layer}_{Overlay}.shape.gii'
+
+def _encode_overlay_file(data, subject: str, Layer: str, Overlay: str) -> bytes:
     
-    gii_data = data.loc[subject,Layer][Overlay].reshape(-1, 1)
+    gii_data = data.get(subject,Layer,Overlay).reshape(-1, 1)
 
     gii = nib.gifti.GiftiImage()
     gii.add_gifti_data_array(
@@ -65,11 +73,23 @@ def create_overlay_file(
             gii_data.astype(np.float32)
         )
     )
-    
-    fname = f'data/sub-{subject}_{Layer}_{Overlay}.shape.gii'
-    nib.save(gii, fname)
+    return gii.to_bytes()
 
-    return fname
+@timed()
+def create_overlay_file(
+    data: dict,
+    subject: str,
+    Layer: str,
+    Overlay: str
+) -> bytes:
+    """
+    GIfTI file of an overlay, encoded in memory. Encoded files are shared 
+    between sessions, so repeated downloads are not encoded again
+    """
+    return load_overlay_file(
+        ("overlay", subject, Layer, Overlay),
+        lambda: _encode_overlay_file(data, subject, Layer, Overlay),
+    )
 
     
 Overlay_to_show = {"Subfields":"Subfields","angio":"angio [a.u.]","T2s":"T2* [ms]",
@@ -77,82 +97,168 @@ Overlay_to_show = {"Subfields":"Subfields","angio":"angio [a.u.]","T2s":"T2* [ms
                   "tSNR":"tSNR [a.u.]","tSNR_vessel_masked":"vessel masked tSNR [a.u.]","beta":"beta [a.u.]"}
 
 colormaps = create_colormaps()
-        
-def create_surface_plot(surface_data, subject:str, Overlay:str, Layer:str, unfolded:bool,show_borders:bool,colorrange=None)->go.FigureWidget:
-    
-    #margins = dict(l=0, r=100, b=20, t=20)
-    margins = dict(l=0,r=0,b=0,t=0)
-    subfields = {1:"Subiculum", 2:"CA1", 3:"CA2", 4:"CA3", 5:"CA4"}
-    
-    
-    boundaries = surface_data.loc[subject,"Canonical"]["Labels"][0].data
-    calc_Borders = False
+
+def surface_colorscale(Overlay:str):
+    idx = 1 if (Overlay=="T2s" or "tSNR" in Overlay) else 0
+    return colormaps[Overlay][idx]
+
+colorscales = load_colorscales(
+    lambda: {key: surface_colorscale(key) for key in colormaps if key != "Subfields"}
+)
+
+#figures are built in these threads, so a slow build does not block the 
+#event loop shared by all sessions
+FIGURE_WORKERS = 4
+figure_executor = ThreadPoolExecutor(max_workers=FIGURE_WORKERS, thread_name_prefix="figure")
+
+async def build_off_loop(func, *args, **kwargs):
+    """
+    Runs func in the figure threads and waits for its result without
+    blocking the event loop. Only for functions that need no session,
+    i.e. that build figure specs rather than widgets
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(figure_executor, functools.partial(func, *args, **kwargs))
+
+#levels of detail of the surface meshes, see load_mesh_lod. The first
+#render picks the finest level below LOD_MAX_VERTICES
+LOD_LEVELS = 4
+LOD_MAX_VERTICES = 20000
+
+def surface_mesh(surface_data, subject:str, Layer:str, unfolded:bool, lod:int=0):
+    """
+    Returns vertices, faces and subfield labels of the mesh shown for a 
+    subject. Unfolded views show the subject's labels on the average 
+    unfolded surface. lod > 0 returns the decimated mesh of that level.
+    """
+    boundaries = surface_data.get(subject,"Canonical","Labels")
     if unfolded:
-        vertices = surface_data.loc["avg","inner"]["unfolded"][1].data
-        faces = surface_data.loc["avg","inner"]["unfolded"][0].data
-        if surface_data.loc[("avg","Canonical"),"Borders"] is None:
-            calc_Borders = True
-    else:
-        vertices = surface_data.loc[subject,Layer]["native"][1].data
-        faces = surface_data.loc[subject,Layer]["native"][0].data
-        if surface_data.loc[(subject,Layer),"Borders"] is None:
-            calc_Borders = True
-        
-    values = surface_data.loc[subject,Layer][Overlay].reshape(-1, 1)
-    
-    
-    #create boundaries as scatter plots. Save to dataframe if not already done to save
-    #computation time
-    if  calc_Borders:
-        scatter_plots = create_border_coordinates(faces, vertices, boundaries)
-        if unfolded:
-            surface_data.at[("avg","Canonical"),"Borders"] = scatter_plots
-        else:
-            surface_data.at[(subject,Layer),"Borders"] = scatter_plots
-        #surface_data.to_pickle(datpath + '/surface_data.pkl')
+        mesh = surface_data.get("avg","inner","unfolded")
     else:
-        if unfolded:
-            scatter_plots = surface_data.loc["avg","Canonical"]["Borders"]
-        else:
-            scatter_plots = surface_data.loc[subject,Layer]["Borders"]
+        mesh = surface_data.get(subject,Layer,"native")
+    if lod:
+        asset = load_mesh_lod(mesh.faces, mesh.vertices, boundaries, lod)
+        return asset["vertices"], asset["faces"], asset["labels"]
+    return mesh.vertices, mesh.faces, boundaries
 
-    #edit display when hovering over data
-    customdata_values = values.flatten()
-    
-    if Overlay == "angio":
-        customdata_values = np.where(customdata_values < 0, "vein", 
-                                     np.where(customdata_values>0,"artery",0))
-    
-    customdata_values = customdata_values.tolist()
+def surface_lod_level(surface_data, subject:str, Layer:str, unfolded:bool)->int:
+    """
+    Finest level of detail whose mesh has at most LOD_MAX_VERTICES vertices,
+    estimated from the full mesh as every level quarters the vertex count
+    """
+    vertices, _, _ = surface_mesh(surface_data, subject, Layer, unfolded)
+    level = int(np.ceil(np.log(len(vertices) / LOD_MAX_VERTICES) / np.log(4)))
+    return min(max(level, 0), LOD_LEVELS - 1)
+
+def surface_values(surface_data, subject:str, Overlay:str, Layer:str, unfolded:bool, lod:int=0):
+    """
+    Overlay values of a subject, resampled onto the mesh of level lod
+    """
+    values = surface_data.get(subject,Layer,Overlay).ravel()
+    if lod:
+        vertices, faces, boundaries = surface_mesh(surface_data, subject, Layer, unfolded)
+        cluster = load_mesh_lod(faces, vertices, boundaries, lod)["cluster"]
+        values = resample_vertex_data(cluster, values)
+    return values
         
-    customdata = np.stack(([subfields[val] for val in boundaries],
-                           [Overlay_to_show[Overlay]]*len(values),
-                           customdata_values), axis=-1)
-    
+@timed()
+def surface_border_traces(surface_data, subject:str, Layer:str, unfolded:bool, lod:int=0):
+    """
+    Border traces of the mesh shown for a subject. Coordinates are cached
+    on disk to save computation time
+    """
+    vertices, faces, boundaries = surface_mesh(surface_data, subject, Layer, unfolded, lod)
+    return create_border_scatter(
+        load_border_coordinates(faces, vertices, boundaries)
+    )
+        
+@timed()
+def surface_overlay_properties(surface_data, subject:str, Overlay:str, Layer:str, colorrange=None,
+                               unfolded:bool=False, lod:int=0)->dict:
+    """
+    Properties of the mesh trace that depend on the overlay. Switching the
+    overlay of a shown surface only requires updating these
+    """
+    values = surface_values(surface_data, subject, Overlay, Layer, unfolded, lod)
+
+    #hover shows the subfield name (customdata of the mesh, see 
+    #create_surface_plot) and the value, which is read from the intensity.
+    #The overlay label is the same for every vertex and only goes into the
+    #template. Angio values are shown as vessel type instead
     if Overlay == "angio":
-        hovertemplate = "Subfield: %{customdata[0]}<br>"+\
-                        "%{customdata[1]}: %{customdata[2]}<extra></extra>"
+        text = np.where(values < 0, "vein", np.where(values > 0, "artery", "0"))
+        value = "%{text}"
     else:
-        hovertemplate = "Subfield: %{customdata[0]}<br>"+\
-                        "%{customdata[1]}: %{customdata[2]:.2f}<extra></extra>"
+        text = None
+        value = "%{intensity:.2f}"
+    hovertemplate = "Subfield: %{customdata}<br>"+\
+                    f"{Overlay_to_show[Overlay]}: {value}<extra></extra>"
 
-    idx = 1 if (Overlay=="T2s" or "tSNR" in Overlay) else 0
-    
     if colorrange is None:
         colorrange =[colormaps[Overlay][2],colormaps[Overlay][3]]
-    #create unfolded mesh
-    fig_data = [go.Mesh3d(
-        x=vertices[:, 0],
-        y=vertices[:, 1],
-        z=vertices[:, 2],
-        i=faces[:, 0],
-        j=faces[:, 1],
-        k=faces[:, 2],
-        intensity=values,
-        opacity=1,
-        colorscale=colormaps[Overlay][idx],
+
+    return dict(
+        intensity=typed_array(values),
+        colorscale=colorscales[Overlay],
         cmin=colorrange[0],
         cmax=colorrange[1],
+        text=text,
+        hovertemplate=hovertemplate,
+    )
+        
+@timed()
+def create_surface_plot(surface_data, subject:str, Overlay:str, Layer:str, unfolded:bool,show_borders:bool,colorrange=None,
+                        lod=0)->go.FigureWidget:
+    """
+    Surface figure of a subject. The figure spec is shared between sessions
+    through the figure cache, only the widget is created per call
+    """
+    spec = load_surface_spec(surface_data, subject, Overlay, Layer, unfolded, show_borders, colorrange, lod)
+    with stage("surface_widget"):
+        return go.FigureWidget(spec)
+
+def load_surface_spec(surface_data, subject:str, Overlay:str, Layer:str, unfolded:bool,show_borders:bool,colorrange=None,
+                      lod=0)->dict:
+    """
+    Cached spec of the surface figure. Does not need a session, so it can 
+    run off the event loop, see build_off_loop
+    """
+    #level of detail, 0 is full resolution
+    if lod == "auto":
+        lod = surface_lod_level(surface_data, subject, Layer, unfolded)
+    
+    if colorrange is not None:
+        colorrange = tuple(colorrange)
+    key = ("surface", subject, Overlay, Layer, unfolded, show_borders, colorrange, lod)
+    return load_figure(key, lambda: create_surface_spec(
+        surface_data, subject, Overlay, Layer, unfolded, show_borders, colorrange, lod
+    ))
+
+@timed()
+def create_surface_spec(surface_data, subject:str, Overlay:str, Layer:str, unfolded:bool,show_borders:bool,colorrange=None,
+                        lod:int=0)->dict:
+    
+    #margins = dict(l=0, r=100, b=20, t=20)
+    margins = dict(l=0,r=0,b=0,t=0)
+    
+    vertices, faces, boundaries = surface_mesh(surface_data, subject, Layer, unfolded, lod)
+    
+    #create boundaries as scatter plots
+    scatter_plots = surface_border_traces(surface_data, subject, Layer, unfolded, lod)
+
+    #create unfolded mesh. Coordinates and faces are sent as binary typed
+    #arrays, see typed_array
+    fig_data = [go.Mesh3d(
+        x=typed_array(vertices[:, 0]),
+        y=typed_array(vertices[:, 1]),
+        z=typed_array(vertices[:, 2]),
+        i=typed_array(faces[:, 0]),
+        j=typed_array(faces[:, 1]),
+        k=typed_array(faces[:, 2]),
+        opacity=1,
+        customdata=load_subfield_names(boundaries),
+        **surface_overlay_properties(surface_data, subject, Overlay, Layer, colorrange,
+                                     unfolded, lod),
         )
     ]
     
@@ -160,13 +266,10 @@ def create_surface_plot(surface_data, subject:str, Overlay:str, Layer:str, unfol
     if show_borders:
         fig_data.extend(scatter_plots)
     
-    fig = go.FigureWidget(
+    fig = go.Figure(
         data=fig_data
         )
     
-    fig.update_traces(customdata=customdata,
-               hovertemplate = hovertemplate)
-    
     if unfolded:
         up=dict(x=0, y=1., z=0)
         eye=dict(x=0, y=0, z=-3.5)
@@ -198,46 +301,13 @@ def create_surface_plot(surface_data, subject:str, Overlay:str, Layer:str, unfol
             height=800,
         )
     )
-    return fig
+    return fig.to_dict()
 
 
-def create_line_plot(depth_data, subject, Overlay:str, contrast:str, vessel_masked:bool)->go.FigureWidget:
-
-    vessel_masked = False if contrast == "breathhold" else vessel_masked
-    labels = {"0":"Subiculum","1":"CA1","2":"CA2","3":"CA3","4":"CA4/DG"}
-    
-    #create a common y-axis range for all subjects
-    yaxis_range = dict.fromkeys(depth_data.keys())
-    yaxis_vals = [[-18,30],[-1.2,4],[20,48],[-1,2.5],[20,180]]
-    
-    for idx,val in enumerate(yaxis_range):
-        yaxis_range[val] = yaxis_vals[idx]
-    
-    #create y-axis title
-    if "beta" in Overlay:
-        if contrast == "pre_vs_post":
-            yaxis_title = (unicodeit.replace("\\beta_{pre}") +
-                           unicodeit.replace("-\\beta_{post}") + " [z]")
-        elif contrast == "memory_vs_math":
-            yaxis_title = (unicodeit.replace("\\beta_{mem}") +
-                           unicodeit.replace("-\\beta_{math}") + " [z]")
-    else:
-        yaxis_title = Overlay_to_show[Overlay]
-    
-    
-    #build figure
-    fig = go.FigureWidget(px.line(template='simple_white')).update_layout(yaxis_title=yaxis_title, xaxis_title=None)
-    
-    #store data in a 3d numpy array, 3rd dimension is subject
-    for idx,s in enumerate(subject):
-        if idx == 0:
-            tmp = depth_data.loc[s,contrast,vessel_masked][Overlay]
-            df_to_show = np.zeros(tmp.shape + (len(subject),))
-            df_to_show[:,:,idx] = tmp
-        else:
-            df_to_show[:,:,idx]= depth_data.loc[s,contrast,vessel_masked][Overlay]
-    
-    
+def _add_subject_traces(fig, df_to_show, subject, Overlay:str, labels:dict):
+    """
+    One trace per subject and subfield
+    """
     #plot all but CA4/DG as lines
     for subfield in range(0,df_to_show.shape[1]-1):
         y = df_to_show[:,subfield,:]
@@ -264,8 +334,8 @@ def create_line_plot(depth_data, subject, Overlay:str, contrast:str, vessel_mask
             #create the actual plot
             fig.add_trace(
                 go.Scatter(
-                x=np.arange(0,len(y)),
-                y=y[:,idx],
+                x=typed_array(np.arange(0,len(y))),
+                y=typed_array(y[:,idx]),
                 line=dict(
                     color=color,
                     width=width,
@@ -340,7 +410,221 @@ def create_line_plot(depth_data, subject, Overlay:str, contrast:str, vessel_mask
                                               f'Subject: {subject[subject_idx]}' +'<extra></extra>')
             subject_idx += 1
             
-        count += 1    
+        count += 1
+
+def _add_consolidated_traces(fig, df_to_show, subject, Overlay:str, labels:dict):
+    """
+    One line trace per subfield holding all subjects as segments separated
+    by NaN, with the subject of every point in customdata. avg is drawn as
+    its own trace on top, so the number of traces does not depend on the
+    number of subjects
+    """
+    subject = np.asarray(subject)
+    is_avg = subject == "avg"
+    n_depth = df_to_show.shape[0]
+    
+    #individual subjects are faded out when shown together with avg
+    groups = [(~is_avg, 3, 0.3 if is_avg.any() else 1, not is_avg.any()),
+              (is_avg, 5, 1, True)]
+    
+    #plot all but CA4/DG as lines
+    x = np.append(np.arange(n_depth), np.nan)
+    for subfield in range(0,df_to_show.shape[1]-1):
+        color = colormaps["Subfields"][0][subfield]
+        for mask, width, opacity, showlegend in groups:
+            if not mask.any():
+                continue
+            #depth x subjects, padded with a row of NaN to separate subjects
+            y = np.vstack([df_to_show[:,subfield,mask],
+                           np.full((1, mask.sum()), np.nan)])
+            fig.add_trace(
+                go.Scatter(
+                    x=typed_array(np.tile(x, mask.sum())),
+                    y=typed_array(y.ravel(order="F")),
+                    customdata=np.repeat(subject[mask], n_depth+1),
+                    line=dict(
+                        color=color,
+                        width=width,
+                        ),
+                    opacity=opacity,
+                    showlegend=showlegend,
+                    legendgroup=labels[str(subfield)],
+                    name=labels[str(subfield)],
+                    hovertemplate=(f'subfield={labels[str(subfield)]}' '<br>depth=%{x}<br>' +
+                                   f'{Overlay_to_show[Overlay]}: ' + '%{y:.2f}<br>' +
+                                   'Subject: %{customdata}<extra></extra>'),
+                    )
+                )
+    
+    #plot CA4/DG as dots
+    for mask, _, opacity, showlegend in groups:
+        if not mask.any():
+            continue
+        y = df_to_show[[9,29],-1,:][:,mask]
+        fig.add_trace(
+            go.Scatter(
+                x=typed_array(np.tile([9,29], mask.sum())),
+                y=typed_array(y.ravel(order="F")),
+                customdata=np.repeat(subject[mask], 2),
+                mode = "markers+text" if showlegend else "markers",
+                text=["DG","CA4"] + [""]*(2*mask.sum()-2) if showlegend else None,
+                textposition="middle left",
+                textfont=dict(
+                    size=22,
+                    color='#9467BD'
+                    ),
+                marker=dict(
+                    color='#9467BD',
+                    size=18,
+                    opacity=opacity
+                    ),
+                showlegend=showlegend,
+                legendgroup=labels["4"],
+                name=labels["4"],
+                hovertemplate=(f'subfield={labels["4"]}' '<br>' +
+                               f'{Overlay_to_show[Overlay]}: ' + '%{y:.2f}<br>' +
+                               'Subject: %{customdata}<extra></extra>'),
+                )
+            )
+
+
+def _add_group_band(fig, df_to_show, subject, Overlay:str, labels:dict, band:str):
+    """
+    Group mean and a filled band (mean +- SEM for band="sem", 95% bootstrap 
+    confidence interval for band="ci") over all selected subjects but avg.
+    Nothing is drawn for less than two subjects
+    """
+    mask = np.asarray(subject) != "avg"
+    if mask.sum() < 2:
+        return
+    stats = group_statistics(df_to_show[:,:,mask])
+    if band == "sem":
+        lower = stats["mean"] - stats["sem"]
+        upper = stats["mean"] + stats["sem"]
+        band_name = "SEM"
+    else:
+        lower, upper = stats["lower"], stats["upper"]
+        band_name = "95% CI"
+    
+    #all but CA4/DG as line with band, drawn as one closed polygon
+    x = np.arange(df_to_show.shape[0])
+    for subfield in range(0,df_to_show.shape[1]-1):
+        color = colormaps["Subfields"][0][subfield]
+        fig.add_trace(
+            go.Scatter(
+                x=typed_array(np.concatenate([x, x[::-1]])),
+                y=typed_array(np.concatenate([upper[:,subfield], lower[::-1,subfield]])),
+                fill="toself",
+                fillcolor=color.replace("rgb","rgba").replace(")",",0.25)"),
+                line=dict(width=0),
+                hoverinfo="skip",
+                showlegend=False,
+                legendgroup=labels[str(subfield)],
+                )
+            )
+        fig.add_trace(
+            go.Scatter(
+                x=typed_array(x),
+                y=typed_array(stats["mean"][:,subfield]),
+                customdata=np.stack([lower[:,subfield], upper[:,subfield]], axis=-1),
+                line=dict(
+                    color=color,
+                    width=5,
+                    dash="dash",
+                    ),
+                showlegend=False,
+                legendgroup=labels[str(subfield)],
+                name=labels[str(subfield)],
+                hovertemplate=(f'subfield={labels[str(subfield)]}' '<br>depth=%{x}<br>' +
+                               f'{Overlay_to_show[Overlay]}: ' + '%{y:.2f}<br>' +
+                               f'{band_name}: ' + '[%{customdata[0]:.2f}, %{customdata[1]:.2f}]<br>' +
+                               f'Group mean (n={mask.sum()})<extra></extra>'),
+                )
+            )
+    
+    #CA4/DG as dots with error bars
+    y = stats["mean"][[9,29],-1]
+    fig.add_trace(
+        go.Scatter(
+            x=[9,29],
+            y=typed_array(y),
+            mode="markers",
+            error_y=dict(
+                type="data",
+                symmetric=False,
+                array=typed_array(upper[[9,29],-1] - y),
+                arrayminus=typed_array(y - lower[[9,29],-1]),
+                color='#9467BD',
+                thickness=3,
+                ),
+            marker=dict(
+                color='#9467BD',
+                size=18,
+                symbol="diamond",
+                ),
+            showlegend=False,
+            legendgroup=labels["4"],
+            name=labels["4"],
+            hovertemplate=(f'subfield={labels["4"]}' '<br>' +
+                           f'{Overlay_to_show[Overlay]}: ' + '%{y:.2f}<br>' +
+                           f'Group mean (n={mask.sum()})<extra></extra>'),
+            )
+        )
+
+@timed()
+def create_line_plot(depth_data, subject, Overlay:str, contrast:str, vessel_masked:bool,
+                     consolidated:bool=False, band:str=None)->go.FigureWidget:
+    """
+    Depth profile figure, see create_line_spec
+    """
+    return go.FigureWidget(
+        create_line_spec(depth_data, subject, Overlay, contrast, vessel_masked, consolidated, band)
+    )
+
+@timed()
+def create_line_spec(depth_data, subject, Overlay:str, contrast:str, vessel_masked:bool,
+                     consolidated:bool=False, band:str=None)->dict:
+    """
+    Depth profiles of the selected subjects. With consolidated, every subfield
+    is drawn as a fixed number of traces regardless of the number of subjects
+    (see _add_consolidated_traces), otherwise as one trace per subject.
+    band ("sem" or "ci") adds the group mean with a SEM or bootstrap 
+    confidence band over the selected subjects
+    """
+
+    vessel_masked = False if contrast == "breathhold" else vessel_masked
+    labels = {"0":"Subiculum","1":"CA1","2":"CA2","3":"CA3","4":"CA4/DG"}
+    
+    #create a common y-axis range for all subjects
+    yaxis_range = {"dSbreathhold":[-18,30], "dSbreathhold_weighted":[-1.2,4],
+                   "T2s":[20,48], "beta":[-1,2.5], "tSNR":[20,180]}
+    
+    #create y-axis title
+    if "beta" in Overlay:
+        if contrast == "pre_vs_post":
+            yaxis_title = (unicodeit.replace("\\beta_{pre}") +
+                           unicodeit.replace("-\\beta_{post}") + " [z]")
+        elif contrast == "memory_vs_math":
+            yaxis_title = (unicodeit.replace("\\beta_{mem}") +
+                           unicodeit.replace("-\\beta_{math}") + " [z]")
+    else:
+        yaxis_title = Overlay_to_show[Overlay]
+    
+    
+    #build figure
+    fig = px.line(template='simple_white').update_layout(yaxis_title=yaxis_title, xaxis_title=None)
+    
+    #data as 3d numpy array, 3rd dimension is subject
+    df_to_show = depth_data.select(subject,contrast,vessel_masked,Overlay)
+    
+    
+    if consolidated:
+        _add_consolidated_traces(fig, df_to_show, subject, Overlay, labels)
+    else:
+        _add_subject_traces(fig, df_to_show, subject, Overlay, labels)
+    
+    if band is not None:
+        _add_group_band(fig, df_to_show, subject, Overlay, labels, band)
 
     #seperate SRLM from the rest
     fig.add_vline(x=9, line_width=4, line_color="Black",opacity=1)
@@ -365,33 +649,4 @@ def create_line_plot(depth_data, subject, Overlay:str, contrast:str, vessel_mask
         ),
         )
     ) 
-    return fig
-
-
-
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
+    return fig.to_dict()
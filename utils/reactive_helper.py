@@ -0,0 +1,46 @@
+import time
+
+from shiny import reactive
+
+"""
+Python file for reactive helpers shared by the modules
+"""
+
+
+def debounce(source, delay: float):
+    """
+    Debounced version of the reactive source, e.g. an input. The returned
+    callable only changes once source has not changed for delay seconds, so
+    dragging a slider invalidates its dependents once instead of on every
+    step. The first value is passed on without delay. Must be called in a
+    session, as the effects belong to it
+    """
+    settled = reactive.Value()
+    changed = reactive.Value(0)
+    changed_at = 0.0
+
+    @reactive.effect
+    def _track():
+        nonlocal changed_at
+        value = source()
+        with reactive.isolate():
+            if not settled.is_set():
+                settled.set(value)
+                return
+            changed_at = time.monotonic()
+            changed.set(changed() + 1)
+
+    @reactive.effect
+    def _settle():
+        changed()
+        wait = changed_at + delay - time.monotonic()
+        if wait > 0:
+            reactive.invalidate_later(wait)
+            return
+        with reactive.isolate():
+            value = source()
+            #inputs return new objects, Value.set only skips identical ones
+            if value != settled():
+                settled.set(value)
+
+    return settled.get
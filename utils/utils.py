@@ -1,49 +1,247 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import plotly.graph_objects as go
+from scipy import sparse
+
+from utils.metrics_helper import timed
 #import sys
 #sys.path.append('/home/pfaffenrot/github/VPF_hippocampus_data_viewer')
 
 #from data import surface_data
 
+subfields = {1:"Subiculum", 2:"CA1", 3:"CA2", 4:"CA3", 5:"CA4"}
+
+_ADJACENCY_CACHE_SIZE = 16
+_adjacency_cache = OrderedDict()
+_adjacency_lock = threading.Lock()
+
+
+def vertex_adjacency(faces, n_vertices=None):
+    """
+    Sparse (CSR) vertex neighborhood matrix of a triangle mesh. Entry (i,j)
+    is 1 if vertices i and j share at least one face, including i == j for
+    every vertex that is part of a face. Built once per mesh and memoized on
+    the content of faces.
+    """
+    faces = np.asarray(faces)
+    if n_vertices is None:
+        n_vertices = int(faces.max()) + 1
+
+    key = (hashlib.sha1(np.ascontiguousarray(faces).tobytes()).hexdigest(), n_vertices)
+    with _adjacency_lock:
+        if key in _adjacency_cache:
+            _adjacency_cache.move_to_end(key)
+            return _adjacency_cache[key]
+
+    # every vertex of a face is a neighbor of every other vertex of that face
+    rows = np.repeat(faces, 3, axis=1).ravel()
+    cols = np.tile(faces, (1, 3)).ravel()
+    adjacency = sparse.csr_matrix(
+        (np.ones(len(rows)), (rows, cols)), shape=(n_vertices, n_vertices)
+    )
+    # duplicate entries of shared edges are summed, we only need membership
+    adjacency.data[:] = 1
+
+    with _adjacency_lock:
+        _adjacency_cache[key] = adjacency
+        if len(_adjacency_cache) > _ADJACENCY_CACHE_SIZE:
+            _adjacency_cache.popitem(last=False)
+    return adjacency
+
+
+def surfdat_smooth(faces, cdata, adjacency=None):
+    """
+    Replaces every vertex value by the nan-mean over its neighborhood, i.e.
+    all vertices sharing a face with it. Done as a single sparse
+    matrix-vector product, so cost scales linearly with mesh size.
+    """
+    cdata_smooth = np.asarray(cdata, dtype=float).reshape(-1)
+    if adjacency is None:
+        adjacency = vertex_adjacency(faces, len(cdata_smooth))
+
+    valid = ~np.isnan(cdata_smooth)
+    sums = adjacency @ np.where(valid, cdata_smooth, 0)
+    counts = adjacency @ valid.astype(float)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        newV = sums / counts
+    return newV.reshape(-1, 1)
+
+
+def subfield_names(labels):
+    """
+    Maps subfield labels to their names with a single vectorized lookup
+    """
+    lookup = np.array([""] + [subfields[key] for key in sorted(subfields)])
+    return lookup[np.asarray(labels, dtype=int).reshape(-1)]
+
+
+def typed_array(arr):
+    """
+    Returns arr in the most compact dtype plotly sends as binary typed array
+    instead of a JSON list: float32 for floats and the smallest unsigned
+    type holding all values for non-negative integers (e.g. face indices).
+    int64/uint64 and 2D arrays are always sent as lists by plotly.
+    """
+    arr = np.asarray(arr)
+    if arr.dtype.kind == "f":
+        return np.ascontiguousarray(arr, dtype=np.float32)
+    if arr.dtype.kind in "ui":
+        if arr.size == 0 or arr.min() < 0:
+            return np.ascontiguousarray(arr, dtype=np.int32)
+        for dtype in (np.uint8, np.uint16, np.uint32):
+            if arr.max() <= np.iinfo(dtype).max:
+                return np.ascontiguousarray(arr, dtype=dtype)
+    return arr
+
 
+@timed()
+def decimate_mesh(vertices, faces, cell_size:float):
+    """
+    Decimates a triangle mesh by vertex clustering. All vertices within the
+    same cubic grid cell of edge length cell_size are merged into their
+    centroid, faces collapsing to edges or points are dropped. Returns the
+    new vertices and faces and, for every original vertex, the index of the
+    vertex it was merged into.
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    faces = np.asarray(faces)
 
-def surfdat_smooth(faces,cdata):
-    cdata_smooth = cdata.astype(float)
-    
-    newV = np.zeros((len(cdata),1))
-    
-    matches = faces[:,:,np.newaxis] == np.arange(len(cdata))
-    f = np.any(matches, axis=1)
-    
-    for idx in range(len(cdata)):
-        v = np.unique(faces[np.argwhere(f[:,idx])])
-        newV[idx] = np.nanmean(cdata_smooth[v])
-    return newV
+    cells = np.floor((vertices - vertices.min(axis=0)) / cell_size).astype(np.int64)
+    _, cluster = np.unique(cells, axis=0, return_inverse=True)
+    cluster = cluster.reshape(-1)
+    n_clusters = int(cluster.max()) + 1
 
+    counts = np.bincount(cluster, minlength=n_clusters)
+    new_vertices = np.stack(
+        [np.bincount(cluster, weights=vertices[:, ii], minlength=n_clusters)
+         for ii in range(3)], axis=1) / counts[:, None]
 
+    new_faces = cluster[faces]
+    keep = (new_faces[:, 0] != new_faces[:, 1]) & \
+           (new_faces[:, 1] != new_faces[:, 2]) & \
+           (new_faces[:, 0] != new_faces[:, 2])
+    new_faces = new_faces[keep]
+    # faces of the same three vertices only need to be drawn once
+    _, first = np.unique(np.sort(new_faces, axis=1), axis=0, return_index=True)
+    new_faces = new_faces[np.sort(first)]
+    return new_vertices, new_faces, cluster
+
+
+def resample_vertex_data(cluster, cdata):
+    """
+    Maps per-vertex data onto a decimated mesh as the nan-mean over all
+    vertices merged into the same vertex
+    """
+    cdata = np.asarray(cdata, dtype=float).reshape(-1)
+    n_clusters = int(cluster.max()) + 1
+    valid = ~np.isnan(cdata)
+    sums = np.bincount(cluster, weights=np.where(valid, cdata, 0), minlength=n_clusters)
+    counts = np.bincount(cluster, weights=valid, minlength=n_clusters)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+def resample_labels(cluster, labels):
+    """
+    Maps per-vertex labels onto a decimated mesh as the most frequent label
+    of all vertices merged into the same vertex
+    """
+    u, codes = np.unique(np.asarray(labels).reshape(-1), return_inverse=True)
+    n_clusters = int(cluster.max()) + 1
+    counts = np.bincount(cluster * len(u) + codes.reshape(-1),
+                         minlength=n_clusters * len(u)).reshape(n_clusters, len(u))
+    return u[counts.argmax(axis=1)]
+
+
+def mean_edge_length(vertices, faces):
+    """
+    Mean length over all face edges of a triangle mesh
+    """
+    vertices = np.asarray(vertices, dtype=float)
+    faces = np.asarray(faces)
+    edges = vertices[faces] - vertices[np.roll(faces, 1, axis=1)]
+    return float(np.linalg.norm(edges, axis=2).mean())
+
+
+def group_statistics(data, n_boot:int=1000, ci:float=95, seed:int=0):
+    """
+    Mean, standard error and bootstrap confidence interval of the mean over
+    the last axis (subjects) of data, ignoring NaN. All resamples are drawn
+    at once as draw counts per subject and reduced with matrix products.
+    Returns a dict of arrays shaped like data without its last axis.
+    """
+    data = np.asarray(data, dtype=float)
+    n = data.shape[-1]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.nanmean(data, axis=-1)
+        count = np.sum(~np.isnan(data), axis=-1)
+        sem = np.nanstd(data, axis=-1, ddof=1) / np.sqrt(count)
+
+        # n_boot resamples of the subjects as the number of times each
+        # subject is drawn, n_boot x n. The resample means are then two
+        # matrix products instead of gathering ... x n_boot x n values
+        counts = np.random.default_rng(seed).multinomial(
+            n, np.full(n, 1/n), size=n_boot
+        ).astype(float)
+        valid = ~np.isnan(data)
+        boot = (np.where(valid, data, 0) @ counts.T) / (valid @ counts.T)
+        lower, upper = np.nanpercentile(
+            boot, [(100 - ci) / 2, 100 - (100 - ci) / 2], axis=-1
+        )
+    return {"mean": mean, "sem": sem, "lower": lower, "upper": upper}
+
+
+@timed()
 def create_border_coordinates(faces,vertices,cdata):
-    
-    u = np.unique(cdata)
+    """
+    Extracts the borders between all labels of cdata in a single pass. A
+    vertex lies on the border of a label if its neighborhood contains that
+    label as well as any other. Faces whose three vertices all lie on the
+    border of a label contribute their centroid to that label's border.
+    Returns a dict of label -> (N,3) array of border coordinates.
+    """
+    cdata = np.asarray(cdata).reshape(-1)
+    faces = np.asarray(faces)
+    vertices = np.asarray(vertices)
+
+    u, codes = np.unique(cdata, return_inverse=True)
+    adjacency = vertex_adjacency(faces, len(cdata))
+
+    # number of neighbors carrying each label, vertices x labels
+    onehot = sparse.csr_matrix(
+        (np.ones(len(codes)), (np.arange(len(codes)), codes)),
+        shape=(len(codes), len(u)),
+    )
+    counts = (adjacency @ onehot).toarray()
+    total = counts.sum(axis=1, keepdims=True)
+    border = (counts > 0) & (counts < total)
+
+    # faces x labels, True if all vertices of the face are border vertices
+    face_border = border[faces].all(axis=1)
+    on_border = np.flatnonzero(face_border.any(axis=1))
+    centroids = vertices[faces[on_border]].mean(axis=1)
+
     v = {}
-    for ii in u:
-        b = (cdata==ii).astype(float)
-        b = surfdat_smooth(faces,b)
-        b = b % 1
-        b = np.argwhere(b>0)
-        b = np.argwhere(np.all(np.isin(faces,b),axis=1))
-        
-        coords = np.zeros((len(b),3))
-        for idx,val in enumerate(b):
-            coords[idx,:] = np.mean(vertices[faces[val,:],:],axis=1)
-        
-        v[str(ii)] = coords
-        
+    for idx, ii in enumerate(u):
+        v[str(ii)] = centroids[face_border[on_border, idx]]
+    return v
+
+
+def create_border_scatter(borders):
+    """
+    Creates one white marker trace per label from the output of
+    create_border_coordinates
+    """
     scatter_plots = []
-    for _,val in v.items():
+    for _,val in borders.items():
         scatter_plots.append(go.Scatter3d(
-                                x=val[:,0],
-                                y=val[:,1],
-                                z=val[:,2],
+                                x=typed_array(val[:,0]),
+                                y=typed_array(val[:,1]),
+                                z=typed_array(val[:,2]),
                                 mode = 'markers',
                                 hoverinfo='none',
                                 marker = dict(
@@ -51,4 +249,3 @@ def create_border_coordinates(faces,vertices,cdata):
                                     size = 5)
                                 ))
     return scatter_plots
-        
\ No newline at end of file